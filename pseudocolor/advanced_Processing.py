@@ -2,14 +2,14 @@ import cv2
 import numpy as np
 import PIL.Image as Image
 
-def guided_color_refine(enhanced_img):
+def guided_color_refine(enhanced_img, d=9, sigma_color=75, sigma_space=75):
     """
     Safe, drop-in replacement for guided color refinement.
     - Accepts: numpy, PIL, torch, tf tensors
     - Never crashes on cvtColor
     - Ensures uint8 BGR image
-    - Ensures matching channel sizes
     - Uses bilateral filtering for edge-preserving refinement
+    - d, sigma_color and sigma_space are the bilateral filter parameters
     """
 
     # ---------------------------
@@ -53,13 +53,8 @@ def guided_color_refine(enhanced_img):
     # ---------------------------
     # Bilateral refinement (safer than ximgproc)
     # ---------------------------
-    A_ref = cv2.bilateralFilter(A, 9, 75, 75)
-    B_ref = cv2.bilateralFilter(B, 9, 75, 75)
-
-    # Ensure matching shapes
-    h, w = L.shape
-    A_ref = cv2.resize(A_ref, (w, h))
-    B_ref = cv2.resize(B_ref, (w, h))
+    A_ref = cv2.bilateralFilter(A, d, sigma_color, sigma_space)
+    B_ref = cv2.bilateralFilter(B, d, sigma_color, sigma_space)
 
     # ---------------------------
     # Merge back to LAB
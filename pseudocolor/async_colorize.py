@@ -0,0 +1,203 @@
+#asyncio api for services that run on an event loop
+#colorize_image blocks for the whole image, called from a coroutine it stalls every other request,
+#so here the work is split the same way as in pipeline.py and the event loop only waits:
+#   decode + 128*128 copy  -> thread pool (PIL and numpy release the GIL)
+#   model inference        -> one DynamicBatcher (batching.py), the variants of all requests in
+#                             flight share one warm model and one model call
+#   post processing        -> process pool (the python level loops of the post processing run
+#                             in other processes and do not fight over the GIL)
+#a bounded semaphore caps the images in flight, a caller that goes over max_in_flight waits in
+#its await, so a flood of requests never piles up decoded images in memory
+#the process pool is started with spawn, so a script using this needs the usual
+#if __name__ == "__main__": guard around its entry point
+#example:
+#   async with AsyncColorizer(model) as colorizer:
+#       gray, color, enhanced = await colorize_image_async(path, colorizer)
+#       async for path, gray, color, enhanced in colorize_batch_async(paths, colorizer):
+#           ...
+
+import asyncio
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from . import metrics
+from .batching import DynamicBatcher
+from .colorization import (ADAPTIVE, average_chroma, cache_key, chroma_for_smalls, downscale, load_gray,
+                           render_outputs, resolve_tta, variants_from_small)
+
+
+#decode stage, runs in the thread pool
+def _decode(image_path):
+    with metrics.timer("decode"):
+        gray_img = load_gray(image_path)
+    with metrics.timer("variants"):
+        small = downscale(gray_img)
+    return gray_img, small
+
+
+#result cache lookup, runs in the thread pool because the key hashes the input file (and the
+#model file on first use), gives back (key, cached outputs or None)
+def _cache_get(cache, image_path, tta, postprocess, saturation, bilateral, refine):
+    key = cache_key(cache, image_path, tta, postprocess, saturation, bilateral, refine)
+    return key, cache.get(key)
+
+
+#averages the predictions of one image, runs in the thread pool
+def _average(preds, names):
+    with metrics.timer("chroma"):
+        return average_chroma(preds, names)
+
+
+class AsyncColorizer:
+    #model is a loaded model or backend (see backends.py), it is only called from the batcher thread
+    #max_in_flight caps the images between decoding and the end of post processing
+    #postprocess_workers is the size of the post processing process pool (None = one per core),
+    #0 runs the post processing in the decode threads instead, which is faster for small images
+    #where sending them to another process costs more than it saves
+    def __init__(self, model, max_in_flight=32, decode_workers=4, postprocess_workers=None,
+                 max_batch_size=32, max_wait_ms=5.0):
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1")
+        self.batcher = DynamicBatcher(model, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+        self.max_in_flight = max_in_flight
+        self._threads = ThreadPoolExecutor(max_workers=decode_workers, thread_name_prefix="lychee-decode")
+        #adaptive tta loops wait on the batcher for most of their time, they get their own threads
+        #so they never hold up decoding, one per image in flight so their rounds can share model calls
+        self._adaptive = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="lychee-adaptive")
+        if postprocess_workers == 0:
+            self._postprocess = self._threads
+        else:
+            #spawn, the batcher thread and the model already exist and forking them is not safe
+            self._postprocess = ProcessPoolExecutor(max_workers=postprocess_workers,
+                                                    mp_context=mp.get_context("spawn"))
+        self._slots = asyncio.BoundedSemaphore(max_in_flight)
+
+    #works out the averaged chroma of one small copy, only the event loop waits for the model
+    async def _chroma(self, small, tta):
+        loop = asyncio.get_running_loop()
+        if isinstance(tta, str) and tta == ADAPTIVE:
+            #adaptive tta decides after every round whether it goes on, that loop runs in a thread
+            #and waits there for the shared batcher
+            (A_avg, B_avg, _), = await loop.run_in_executor(self._adaptive, chroma_for_smalls, [small],
+                                                            self.batcher, tta)
+            return A_avg, B_avg
+        batch, names = variants_from_small(small, tta)
+        metrics.count("inference_rows", len(batch))
+        metrics.count("tta_variants", len(names))
+        preds = await asyncio.wrap_future(self.batcher.submit(batch))
+        return await loop.run_in_executor(self._threads, _average, preds, names)
+
+    #same settings and result as colorization.colorize_image: (gray, color, enhanced) pil images
+    async def colorize_image(self, image_path, tta="full", postprocess="classic", cache=None, saturation=1.2,
+                             bilateral=None, refine="bilateral"):
+        resolve_tta(tta)
+        loop = asyncio.get_running_loop()
+        async with self._slots:
+            key = None
+            if cache is not None:
+                key, cached = await loop.run_in_executor(self._threads, _cache_get, cache, image_path, tta,
+                                                         postprocess, saturation, bilateral, refine)
+                if cached is not None:
+                    metrics.count("result_cache_hits")
+                    return cached
+
+            gray_img, small = await loop.run_in_executor(self._threads, _decode, image_path)
+            A_avg, B_avg = await self._chroma(small, tta)
+            with metrics.timer("postprocess"):
+                color_img, enhanced = await loop.run_in_executor(self._postprocess, render_outputs, gray_img, A_avg,
+                                                                 B_avg, postprocess, saturation, bilateral, refine)
+            metrics.count("images")
+
+            if cache is not None:
+                await loop.run_in_executor(self._threads, cache.put, key, (gray_img, color_img, enhanced))
+        return gray_img, color_img, enhanced
+
+    #colorizes paths (any iterable, also an async one) with up to max_in_flight images at once,
+    #gives back (path, gray, color, enhanced) in the order the images finish
+    #new paths are only taken when a slot is free, so a long or endless source is read as it goes
+    #on_error(path, error) is called for an image that fails and that image is skipped, without it
+    #the error is raised here and the images still in flight are cancelled
+    async def colorize_batch(self, paths, on_error=None, **settings):
+        tasks = set()
+        done = asyncio.Queue()
+        in_flight = 0
+
+        async def one(path):
+            try:
+                result = await self.colorize_image(path, **settings)
+            except Exception as e:
+                result = e
+            done.put_nowait((path, result))
+
+        def start(path):
+            nonlocal in_flight
+            in_flight += 1
+            task = asyncio.ensure_future(one(path))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        async def finished(limit):
+            #gives back finished images until no more than limit are in flight
+            nonlocal in_flight
+            while in_flight > limit:
+                path, result = await done.get()
+                in_flight -= 1
+                if isinstance(result, Exception) and on_error is not None:
+                    metrics.count("images_failed")
+                    on_error(path, result)
+                    continue
+                yield _result(path, result)
+
+        try:
+            if hasattr(paths, "__aiter__"):
+                async for path in paths:
+                    async for item in finished(self.max_in_flight - 1):
+                        yield item
+                    start(path)
+            else:
+                for path in paths:
+                    async for item in finished(self.max_in_flight - 1):
+                        yield item
+                    start(path)
+            async for item in finished(0):
+                yield item
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def stats(self):
+        return self.batcher.stats()
+
+    #stops the batcher and the pools, the images in flight should be awaited first
+    def close(self):
+        self.batcher.close()
+        self._threads.shutdown()
+        self._adaptive.shutdown()
+        if self._postprocess is not self._threads:
+            self._postprocess.shutdown()
+
+    async def aclose(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+
+#turns one finished item of colorize_batch into (path, gray, color, enhanced) or raises its error
+def _result(path, result):
+    if isinstance(result, Exception):
+        raise result
+    return (path,) + tuple(result)
+
+
+#colorizes one image without blocking the event loop, see AsyncColorizer.colorize_image
+async def colorize_image_async(image_path, colorizer, **settings):
+    return await colorizer.colorize_image(image_path, **settings)
+
+
+#async iterator over (path, gray, color, enhanced) of many images, see AsyncColorizer.colorize_batch
+def colorize_batch_async(paths, colorizer, **settings):
+    return colorizer.colorize_batch(paths, **settings)
@@ -0,0 +1,224 @@
+#inference backends
+#every backend follows the same small protocol (see InferenceBackend):
+#   load()               loads the model, called once before the first prediction
+#   warm_up()            runs one dummy batch so the first real call is not slow
+#   predict_batch(batch) (N,input_size,input_size,1) float32 -> (N,input_size,input_size,3)
+#   input_size           side of the square model input
+#a backend can be passed as the model anywhere in the pipeline (run_model calls predict_batch)
+#heavy libraries (tensorflow, onnxruntime) are only imported in load()
+#
+#load_backend picks the backend from the model path:
+#   .keras            KerasBackend
+#   .tflite           TFLiteBackend
+#   .onnx             OnnxBackend
+#   folder            SavedModelBackend (from export_model.py)
+#   "stand-in"        NumpyStandInBackend, no model file and no tensorflow needed
+
+import os
+import threading
+import time
+
+import numpy as np
+import cv2
+
+from .colorization import IMG_SIZE, load_model
+
+STAND_IN = "stand-in"
+
+
+class InferenceBackend:
+    input_size = IMG_SIZE
+
+    def __init__(self):
+        self.loaded = False
+
+    def load(self):
+        if not self.loaded:
+            self._load()
+            self.loaded = True
+        return self
+
+    def _load(self):
+        pass
+
+    def warm_up(self):
+        self.load()
+        self.predict_batch(np.zeros((1, self.input_size, self.input_size, 1), dtype=np.float32))
+
+    def predict_batch(self, batch):
+        raise NotImplementedError
+
+
+#the original keras model, loaded with perceptual_loss
+class KerasBackend(InferenceBackend):
+    def __init__(self, model_path):
+        super().__init__()
+        self.model_path = model_path
+        self.model = None
+
+    def _load(self):
+        self.model = load_model(self.model_path)
+
+    def predict_batch(self, batch):
+        self.load()
+        return np.asarray(self.model.predict_on_batch(np.asarray(batch, dtype=np.float32)))
+
+
+#XLA compiled tf.function saved by export_model.export_savedmodel
+class SavedModelBackend(InferenceBackend):
+    def __init__(self, model_dir):
+        super().__init__()
+        self.model_dir = model_dir
+        self._serve = None
+
+    def _load(self):
+        import tensorflow as tf
+        self._tf = tf
+        self._loaded = tf.saved_model.load(self.model_dir)
+        self._serve = self._loaded.signatures["serving_default"]
+        #signature functions only take keyword arguments, the one input is called by its name
+        self._input_name = next(iter(self._serve.structured_input_signature[1]))
+
+    def predict_batch(self, batch):
+        self.load()
+        x = self._tf.constant(np.asarray(batch, dtype=np.float32))
+        outputs = self._serve(**{self._input_name: x})
+        return next(iter(outputs.values())).numpy()
+
+
+#tflite model, float32, float16 or int8 quantized
+#uses the small tflite_runtime package when it is installed, otherwise tensorflow's interpreter
+class TFLiteBackend(InferenceBackend):
+    def __init__(self, model_path, num_threads=None):
+        super().__init__()
+        self.model_path = model_path
+        self.num_threads = num_threads
+        self._batch = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+        self._interpreter = Interpreter(model_path=self.model_path, num_threads=self.num_threads)
+        self._input = self._interpreter.get_input_details()[0]
+        self._output = self._interpreter.get_output_details()[0]
+
+    def predict_batch(self, batch):
+        self.load()
+        #the interpreter is not thread safe, a gui job that was replaced can still be in here
+        with self._lock:
+            batch = np.asarray(batch, dtype=np.float32)
+            #the model is exported with batch 1, the input is resized when the batch size changes
+            if self._batch != len(batch):
+                self._interpreter.resize_tensor_input(self._input["index"], batch.shape)
+                self._interpreter.allocate_tensors()
+                self._input = self._interpreter.get_input_details()[0]
+                self._output = self._interpreter.get_output_details()[0]
+                self._batch = len(batch)
+
+            #int8 models with integer input/output need the values scaled
+            x = batch
+            scale, zero_point = self._input["quantization"]
+            if self._input["dtype"] != np.float32 and scale:
+                x = np.round(batch / scale + zero_point).astype(self._input["dtype"])
+
+            self._interpreter.set_tensor(self._input["index"], x)
+            self._interpreter.invoke()
+            y = self._interpreter.get_tensor(self._output["index"])
+
+            scale, zero_point = self._output["quantization"]
+            if self._output["dtype"] != np.float32 and scale:
+                y = (y.astype(np.float32) - zero_point) * scale
+            return y
+
+
+#onnx model run with onnxruntime (for example converted with tf2onnx)
+class OnnxBackend(InferenceBackend):
+    def __init__(self, model_path, num_threads=None):
+        super().__init__()
+        self.model_path = model_path
+        self.num_threads = num_threads
+
+    def _load(self):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        if self.num_threads:
+            options.intra_op_num_threads = self.num_threads
+        self._session = ort.InferenceSession(self.model_path, options, providers=["CPUExecutionProvider"])
+        self._input_name = self._session.get_inputs()[0].name
+
+    def predict_batch(self, batch):
+        self.load()
+        return self._session.run(None, {self._input_name: np.asarray(batch, dtype=np.float32)})[0]
+
+
+#deterministic stand-in for the real model, only numpy and opencv
+#it gives smooth, plausible looking chroma that depends on the input, so the whole pipeline
+#(batching, post processing, caches, servers) can be benchmarked and load tested without the
+#100+ mb model or tensorflow; delay_ms adds a fixed cost per image to act like a real model
+class NumpyStandInBackend(InferenceBackend):
+    def __init__(self, delay_ms=0.0, seed=0):
+        super().__init__()
+        self.delay_ms = delay_ms
+        rng = np.random.default_rng(seed)
+        self._phase = rng.uniform(0, 2 * np.pi, size=2).astype(np.float32)
+
+    def predict_batch(self, batch):
+        batch = np.asarray(batch, dtype=np.float32)
+        if self.delay_ms:
+            time.sleep(self.delay_ms * len(batch) / 1000.0)
+
+        out = np.empty(batch.shape[:3] + (3,), dtype=np.float32)
+        for i, x in enumerate(batch[:, :, :, 0]):
+            #blurred input drives the color, so it follows the image content but stays smooth
+            smooth = cv2.GaussianBlur(x, (0, 0), 4)
+            out[i, :, :, 0] = x
+            out[i, :, :, 1] = 0.5 + 0.2 * np.sin(2 * np.pi * smooth + self._phase[0])
+            out[i, :, :, 2] = 0.5 + 0.2 * np.cos(2 * np.pi * smooth + self._phase[1])
+        return out
+
+
+#true when the backend of model_path runs on tensorflow itself (keras and saved model)
+def uses_tensorflow(model_path):
+    return model_path != STAND_IN and not model_path.lower().endswith((".tflite", ".onnx"))
+
+
+#environment variables with the thread count of the math libraries under numpy
+#they are only read when numpy is first imported, so a worker process has to be started with them
+#(see thread_env), setting them inside the worker is too late
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")
+
+
+#the THREAD_ENV_VARS of a process that may use num_threads threads
+def thread_env(num_threads):
+    return dict.fromkeys(THREAD_ENV_VARS, str(num_threads))
+
+
+#caps the threads of opencv and, for tensorflow backends, tensorflow itself
+#tensorflow only takes this before it runs anything, so call it before load_backend
+#used by worker processes that share the cores with other workers (see parallel_batch.py), the
+#math libraries are capped by starting those with thread_env
+def pin_threads(num_threads, model_path=None):
+    cv2.setNumThreads(num_threads)
+    if model_path is not None and uses_tensorflow(model_path):
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+#creates and loads the backend that fits model_path (see the list at the top)
+#num_threads caps the threads of the tflite and onnx runtimes
+def load_backend(model_path, num_threads=None):
+    if model_path == STAND_IN:
+        backend = NumpyStandInBackend()
+    elif model_path.lower().endswith(".tflite"):
+        backend = TFLiteBackend(model_path, num_threads)
+    elif model_path.lower().endswith(".onnx"):
+        backend = OnnxBackend(model_path, num_threads)
+    elif os.path.isdir(model_path):
+        backend = SavedModelBackend(model_path)
+    else:
+        backend = KerasBackend(model_path)
+    return backend.load()
@@ -0,0 +1,130 @@
+#command line tool that colorizes every image in a folder
+#the tta variants of several images are packed into shared model batches
+#example:
+#   python -m pseudocolor.batch_colorize test_images OUTPUT --batch-size 16 --tta fast
+
+import argparse
+import os
+import time
+
+from .backends import load_backend
+from . import metrics
+from .colorization import MODEL_PATH, POSTPROCESS_MODES, REFINE_MODES, TTA_MODES, check_refine, colorize_batch
+from .pipeline import colorize_stream
+from .result_cache import ResultCache
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+
+#walks the input folder and gives back all image paths in a stable order
+def find_images(input_dir, recursive=True):
+    paths = []
+    for root, dirs, files in os.walk(input_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(root, name))
+        if not recursive:
+            break
+    return paths
+
+
+#works out where the color and enhanced results of one input go
+#the folder layout of the input folder is kept in the output folder
+def output_paths(image_path, input_dir, output_dir):
+    rel = os.path.relpath(image_path, input_dir)
+    base = os.path.join(output_dir, os.path.splitext(rel)[0])
+    return base + "_color.png", base + "_enhanced.png"
+
+
+#colorizes all images and writes each result as soon as it is ready
+#stream=True overlaps decode, inference and post processing (see pipeline.py)
+#an image that can not be read is reported and skipped, the rest of the folder goes on
+#gives back the number of images done and failed and the seconds it took
+def run(input_dir, output_dir, model, batch_size=8, tta="full", recursive=True,
+        stream=False, decode_workers=4, postprocess_workers=None, postprocess="classic", cache=None,
+        refine="bilateral"):
+    paths = find_images(input_dir, recursive)
+    start = time.perf_counter()
+    done = 0
+    failed = []
+
+    def on_error(path, error):
+        failed.append(path)
+        print(f"[{done + len(failed)}/{len(paths)}] failed {path} ({error})")
+
+    if stream:
+        results = colorize_stream(paths, model, batch_size=batch_size, tta=tta, postprocess=postprocess, cache=cache,
+                                  decode_workers=decode_workers,
+                                  postprocess_workers=postprocess_workers, max_pending=max(32, batch_size * 2),
+                                  refine=refine, on_error=on_error)
+    else:
+        results = colorize_batch(paths, model, batch_size=batch_size, tta=tta, postprocess=postprocess, cache=cache,
+                                 refine=refine, on_error=on_error)
+
+    for path, gray, color, enhanced in results:
+        color_path, enhanced_path = output_paths(path, input_dir, output_dir)
+        os.makedirs(os.path.dirname(color_path), exist_ok=True)
+        color.save(color_path)
+        enhanced.save(enhanced_path)
+        done += 1
+        print(f"[{done + len(failed)}/{len(paths)}] {path}")
+
+    return done, len(failed), time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="colorize every grayscale image in a folder")
+    parser.add_argument("input_dir", help="folder with grayscale images")
+    parser.add_argument("output_dir", help="folder where the colorized images are written")
+    parser.add_argument("--model", default=MODEL_PATH, help="model file: .keras, .tflite or an exported saved model folder")
+    parser.add_argument("--batch-size", type=int, default=8, help="number of images per model call")
+    parser.add_argument("--tta", default="full", choices=sorted(TTA_MODES), help="test time augmentation set")
+    parser.add_argument("--postprocess", default="classic", choices=POSTPROCESS_MODES,
+                        help="post processing engine, fused is faster on big images")
+    parser.add_argument("--refine", default="bilateral", choices=REFINE_MODES,
+                        help="chroma refinement, guided and joint_bilateral follow the image edges and are faster on big images")
+    parser.add_argument("--no-recursive", action="store_true", help="only look at the top level of input_dir")
+    parser.add_argument("--stream", action="store_true", help="overlap decode, inference and post processing")
+    parser.add_argument("--decode-workers", type=int, default=4, help="decode threads when streaming")
+    parser.add_argument("--postprocess-workers", type=int, default=None,
+                        help="post processing processes when streaming (default: one per core)")
+    parser.add_argument("--cache-dir", default=None, help="reuse results of images that were colorized before")
+    parser.add_argument("--cache-size-mb", type=int, default=2048, help="size limit of the result cache")
+    parser.add_argument("--metrics", action="store_true", help="print p50/p95 times of every stage at the end")
+    parser.add_argument("--metrics-json", default=None, help="also write the stage metrics to this json file")
+    args = parser.parse_args(argv)
+    try:
+        check_refine(args.postprocess, args.refine)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.metrics or args.metrics_json:
+        metrics.enable()
+
+    cache = None
+    if args.cache_dir:
+        cache = ResultCache(args.cache_dir, model_path=args.model, max_bytes=args.cache_size_mb * 1024 * 1024)
+
+    model = load_backend(args.model)
+    print("model loaded")
+
+    done, failed, seconds = run(args.input_dir, args.output_dir, model,
+                        batch_size=args.batch_size, tta=args.tta, recursive=not args.no_recursive,
+                        stream=args.stream, decode_workers=args.decode_workers,
+                        postprocess_workers=args.postprocess_workers, postprocess=args.postprocess,
+                        cache=cache, refine=args.refine)
+
+    rate = done / seconds if seconds > 0 else 0.0
+    print(f"colorized {done} images in {seconds:.2f}s ({rate:.2f} images/s), {failed} failed")
+    if cache is not None:
+        print(f"cache: {cache.stats()}")
+    if args.metrics:
+        metrics.print_summary()
+    if args.metrics_json:
+        with open(args.metrics_json, "w") as f:
+            f.write(metrics.to_json(indent=2))
+
+
+if __name__ == "__main__":
+    main()
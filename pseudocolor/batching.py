@@ -0,0 +1,142 @@
+#dynamic request batcher for concurrent callers
+#callers hand in preprocessed (n,128,128,1) tensors and get a future back, one worker thread
+#packs everything that arrives within max_wait_ms (or until max_batch_size rows) into one model call
+#a lone request only waits max_wait_ms, so single request latency stays about the same
+#
+#the batcher has predict_on_batch like a keras model, so it can be passed as the model to
+#colorize_image from many threads at once:
+#   batcher = DynamicBatcher(model)
+#   colorize_image(path, batcher)
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+from . import metrics
+from .colorization import run_model
+
+#marks the end of the queue
+_CLOSE = object()
+
+
+class DynamicBatcher:
+    def __init__(self, model, max_batch_size=32, max_wait_ms=5.0):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.batches = 0
+        self.rows = 0
+        self.requests = 0
+        self._queue = queue.Queue()
+        self._closed = False
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="DynamicBatcher", daemon=True)
+        self._thread.start()
+
+    #queues a (n,128,128,1) batch, the future gives back the (n,128,128,3) predictions
+    def submit(self, batch):
+        batch = np.asarray(batch, dtype=np.float32)
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("batcher is closed")
+            self._queue.put((batch, future))
+        return future
+
+    #blocking version of submit, same call as on a keras model
+    def predict_on_batch(self, batch):
+        return self.submit(batch).result()
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(_CLOSE)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "rows": self.rows,
+            "waiting": self._queue.qsize(),
+            "mean_batch_rows": self.rows / self.batches if self.batches else 0.0,
+        }
+
+    def _run(self):
+        closing = False
+        #a request that did not fit into the last batch, it starts the next one
+        carry = None
+        while not closing:
+            if carry is not None:
+                item, carry = carry, None
+            else:
+                item = self._queue.get()
+            if item is _CLOSE:
+                break
+
+            #the deadline starts when the first request of the batch arrives
+            pending = [item]
+            rows = len(item[0])
+            deadline = time.monotonic() + self.max_wait
+            while rows < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _CLOSE:
+                    closing = True
+                    break
+                if rows + len(item[0]) > self.max_batch_size:
+                    carry = item
+                    break
+                pending.append(item)
+                rows += len(item[0])
+
+            self._flush(pending)
+
+        #anything that came in after close gets an error instead of hanging
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _CLOSE:
+                item[1].set_exception(RuntimeError("batcher is closed"))
+
+    def _flush(self, pending):
+        pending = [(batch, future) for batch, future in pending if future.set_running_or_notify_cancel()]
+        if not pending:
+            return
+
+        try:
+            with metrics.timer("inference_batch"):
+                preds = run_model(self.model, np.concatenate([batch for batch, _ in pending]))
+        except Exception as e:
+            for _, future in pending:
+                future.set_exception(e)
+            return
+
+        start = 0
+        for batch, future in pending:
+            future.set_result(preds[start:start + len(batch)])
+            start += len(batch)
+
+        self.batches += 1
+        self.requests += len(pending)
+        self.rows += start
@@ -0,0 +1,240 @@
+#benchmark of the colorization pipeline with a timing for every stage
+#runs over the images in test_images/ and over synthetic images of any size, and reports for each
+#stage the wall time, throughput and peak memory, the report is written as json so runs can be
+#compared (--compare old.json fails when a stage got slower than --tolerance)
+#example:
+#   python -m pseudocolor.benchmark --synthetic 1024x768 4000x3000 --output bench.json
+#   python -m pseudocolor.benchmark --model stand-in --compare bench.json
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import cv2
+from PIL import Image
+
+from .advanced_Processing import guided_color_refine
+from .backends import STAND_IN, load_backend
+from .batch_colorize import find_images
+from .colorization import (MODEL_PATH, TTA_MODES, average_chroma, build_variants, load_gray, merge_chroma,
+                           resolve_tta, run_model)
+from .luminance_processing import luminance
+from .saturation_Processing import boost_saturation
+
+TEST_IMAGES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_images")
+
+#the timed stages in pipeline order (the classic post processing)
+STAGES = ("decode", "variants", "inference", "chroma", "merge", "luminance", "saturation", "guided_refine")
+
+
+#one synthetic grayscale image as encoded jpeg bytes, so decoding is part of the measurement
+#the content is smooth shapes plus noise, which is closer to a photo than pure noise
+def synthetic_image(width, height, seed=0):
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:height, 0:width].astype(np.float32)
+    img = 128 + 60 * np.sin(xx / (width / 7)) * np.cos(yy / (height / 5)) + rng.normal(0, 12, (height, width))
+    ok, data = cv2.imencode(".jpg", np.clip(img, 0, 255).astype(np.uint8), [cv2.IMWRITE_JPEG_QUALITY, 92])
+    return data.tobytes()
+
+
+def parse_size(text):
+    w, h = text.lower().split("x")
+    return int(w), int(h)
+
+
+#runs all stages on one input, calling measure(stage, fn) around each one
+def run_stages(source, model, names, saturation, measure):
+    state = {}
+    state["gray"] = measure("decode", lambda: load_gray(source))
+    state["variants"] = measure("variants", lambda: build_variants(state["gray"], names)[0])
+    state["preds"] = measure("inference", lambda: run_model(model, state["variants"]))
+    A_avg, B_avg = measure("chroma", lambda: average_chroma(state["preds"], names))
+    state["color"] = measure("merge", lambda: merge_chroma(state["gray"], A_avg, B_avg))
+    state["lum"] = measure("luminance", lambda: luminance(state["color"], state["gray"]))
+    state["sat"] = measure("saturation", lambda: boost_saturation(state["lum"], factor=saturation))
+    measure("guided_refine", lambda: guided_color_refine(state["sat"]))
+
+
+def _timer(times):
+    def measure(stage, fn):
+        start = time.perf_counter()
+        result = fn()
+        times[stage].append(time.perf_counter() - start)
+        return result
+    return measure
+
+
+#tracemalloc slows everything down, so memory is measured in its own pass
+def _memory_meter(peaks):
+    def measure(stage, fn):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        result = fn()
+        peak = tracemalloc.get_traced_memory()[1] - base
+        peaks[stage] = max(peaks.get(stage, 0), peak)
+        return result
+    return measure
+
+
+def _percentile(values, q):
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+#benchmarks one input set (a list of (label, source) pairs), gives back the json friendly result
+def benchmark_inputs(inputs, model, tta="full", saturation=1.2, repeat=3, memory=True):
+    names = resolve_tta(tta)
+    times = {stage: [] for stage in STAGES}
+
+    #one untimed run so lazy setup (first model call, opencv init) is not counted
+    run_stages(inputs[0][1], model, names, saturation, lambda stage, fn: fn())
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for _, source in inputs:
+            run_stages(source, model, names, saturation, _timer(times))
+    wall = time.perf_counter() - start
+    images = repeat * len(inputs)
+
+    peaks = {}
+    if memory:
+        tracemalloc.start()
+        try:
+            for _, source in inputs:
+                run_stages(source, model, names, saturation, _memory_meter(peaks))
+        finally:
+            tracemalloc.stop()
+
+    stages = {}
+    for stage in STAGES:
+        values = times[stage]
+        total = sum(values)
+        stages[stage] = {
+            "total_s": round(total, 6),
+            "mean_ms": round(1000 * total / len(values), 3),
+            "p50_ms": round(1000 * _percentile(values, 50), 3),
+            "p95_ms": round(1000 * _percentile(values, 95), 3),
+            "images_per_s": round(len(values) / total, 3) if total > 0 else None,
+            "peak_mb": round(peaks[stage] / 2 ** 20, 2) if stage in peaks else None,
+        }
+
+    return {
+        "images": images,
+        "wall_s": round(wall, 4),
+        "images_per_s": round(images / wall, 3),
+        "stages": stages,
+    }
+
+
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #linux reports kilobytes, macos bytes
+    return round(rss / (2 ** 20 if sys.platform == "darwin" else 2 ** 10), 1)
+
+
+#versions and machine details that go into a report
+def environment():
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "pillow": Image.__version__,
+        "cpus": os.cpu_count(),
+    }
+
+
+#compares two reports and gives back the stages that got slower than tolerance (0.1 = 10%)
+def compare_reports(old, new, tolerance=0.1):
+    regressions = []
+    for name, run in new["runs"].items():
+        if name not in old.get("runs", {}):
+            continue
+        for stage, result in run["stages"].items():
+            before = old["runs"][name]["stages"].get(stage)
+            if not before or not before["mean_ms"]:
+                continue
+            change = result["mean_ms"] / before["mean_ms"] - 1
+            if change > tolerance:
+                regressions.append({"run": name, "stage": stage, "before_ms": before["mean_ms"],
+                                    "after_ms": result["mean_ms"], "change": round(change, 3)})
+    return regressions
+
+
+def print_report(report):
+    for name, run in report["runs"].items():
+        print(f"\n{name}: {run['images']} images, {run['wall_s']:.2f}s, {run['images_per_s']:.2f} images/s")
+        print(f"  {'stage':<14}{'mean ms':>10}{'p95 ms':>10}{'img/s':>10}{'peak MB':>10}")
+        for stage, r in run["stages"].items():
+            peak = "-" if r["peak_mb"] is None else f"{r['peak_mb']:.1f}"
+            print(f"  {stage:<14}{r['mean_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['images_per_s'] or 0:>10.1f}{peak:>10}")
+    print(f"\npeak rss: {report['peak_rss_mb']} MB")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="per stage benchmark of the colorization pipeline")
+    parser.add_argument("--model", default=None,
+                        help="model file or 'stand-in' (default: the keras model, or the stand-in if it is missing)")
+    parser.add_argument("--images", default=TEST_IMAGES, help="folder of real test images, '' to skip")
+    parser.add_argument("--synthetic", nargs="*", default=["512x512", "2048x1536"],
+                        help="sizes of synthetic images, for example 4000x3000")
+    parser.add_argument("--tta", default="full", choices=sorted(TTA_MODES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-memory", action="store_true", help="skip the (slow) peak memory pass")
+    parser.add_argument("--output", default=None, help="write the json report here")
+    parser.add_argument("--compare", default=None, help="earlier json report to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed slowdown per stage for --compare")
+    args = parser.parse_args(argv)
+
+    model_path = args.model or (MODEL_PATH if os.path.exists(MODEL_PATH) else STAND_IN)
+    if model_path == STAND_IN:
+        print("using the numpy stand-in model, inference timings are not the real model's")
+    model = load_backend(model_path)
+
+    input_sets = {}
+    if args.images:
+        paths = find_images(args.images)
+        if paths:
+            input_sets["test_images"] = [(p, p) for p in paths]
+    for size in args.synthetic:
+        w, h = parse_size(size)
+        input_sets[f"synthetic_{w}x{h}"] = [(size, synthetic_image(w, h))]
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "model": model_path,
+        "tta": args.tta,
+        "repeat": args.repeat,
+        "environment": environment(),
+        "runs": {},
+    }
+    for name, inputs in input_sets.items():
+        report["runs"][name] = benchmark_inputs(inputs, model, args.tta, repeat=args.repeat,
+                                                memory=not args.no_memory)
+    report["peak_rss_mb"] = _peak_rss_mb()
+
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"report written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_reports(json.load(f), report, args.tolerance)
+        for r in regressions:
+            print(f"REGRESSION {r['run']}/{r['stage']}: {r['before_ms']} ms -> {r['after_ms']} ms (+{r['change']:.0%})")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#cache for the averaged 128*128 a/b chroma that comes out of the model
+#post processing only needs this small artifact (128kb per image) and the gray input, so when it is
+#kept the saturation or bilateral settings can be changed without running the model again
+#entries live in memory and, with a cache_dir, also on disk as .npy files
+
+import hashlib
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+from .result_cache import file_hash, model_version
+
+
+#writes the a/b chroma as one (2,128,128) float32 .npy file
+def save_chroma(path, A_avg, B_avg):
+    np.save(path, np.stack([A_avg, B_avg]).astype(np.float32))
+
+
+#reads a chroma file written by save_chroma, gives back (A_avg, B_avg)
+def load_chroma(path):
+    ab = np.load(path)
+    return ab[0], ab[1]
+
+
+class ChromaCache:
+    def __init__(self, cache_dir=None, model_path=None, max_items=256):
+        self.cache_dir = cache_dir
+        self.max_items = max_items
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+        self.model_path = model_path
+
+    #worked out on first use and not at startup, see model_version
+    @property
+    def model_id(self):
+        return model_version(self.model_path)
+
+    #the chroma only depends on the input image, the model and the tta variants
+    def key(self, image_path, tta_names):
+        settings = hashlib.blake2b((self.model_id + "|" + ",".join(tta_names)).encode(), digest_size=8)
+        return file_hash(image_path) + "-" + settings.hexdigest()
+
+    #gives back (A_avg, B_avg) or None
+    def get(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key]
+
+        path = self._path(key)
+        if path is not None and os.path.exists(path):
+            chroma = load_chroma(path)
+            with self._lock:
+                self.hits += 1
+                self._remember(key, chroma)
+            return chroma
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, A_avg, B_avg):
+        chroma = (np.asarray(A_avg, dtype=np.float32), np.asarray(B_avg, dtype=np.float32))
+        with self._lock:
+            self._remember(key, chroma)
+
+        path = self._path(key)
+        if path is not None:
+            #write next to the final name and rename, so readers never see half a file
+            #the temp name is unique, two jobs can put the same key at the same time
+            tmp = f"{path}.{uuid.uuid4().hex}.tmp.npy"
+            save_chroma(tmp, *chroma)
+            os.replace(tmp, path)
+
+    def _remember(self, key, chroma):
+        self._memory[key] = chroma
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    def _path(self, key):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "in_memory": len(self._memory)}
@@ -0,0 +1,66 @@
+#thin client for the colorization server (server.py)
+#it only needs PIL, so scripts and the gui start right away without loading tensorflow
+#address is "http://host:port" or the path of a unix socket
+
+import base64
+import http.client
+import io
+import json
+import socket
+from urllib.parse import urlencode, urlparse
+
+from PIL import Image
+
+
+#http connection that talks over a unix socket
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class ColorizeClient:
+    def __init__(self, address="http://127.0.0.1:8765", timeout=300):
+        self.address = address
+        self.timeout = timeout
+
+    def _connect(self):
+        if self.address.startswith(("http://", "https://")):
+            url = urlparse(self.address)
+            return http.client.HTTPConnection(url.hostname, url.port or 80, timeout=self.timeout)
+        return _UnixHTTPConnection(self.address, timeout=self.timeout)
+
+    def _request(self, method, path, body=None):
+        conn = self._connect()
+        try:
+            conn.request(method, path, body=body)
+            response = conn.getresponse()
+            data = response.read()
+            if response.status != 200:
+                raise RuntimeError(f"server error {response.status}: {response.reason}")
+            return data
+        finally:
+            conn.close()
+
+    def health(self):
+        return json.loads(self._request("GET", "/health"))
+
+    #same result as colorization.colorize_image: (gray, color, enhanced) pil images
+    def colorize_image(self, image_path, tta="full", postprocess="classic", refine="bilateral"):
+        with open(image_path, "rb") as f:
+            body = f.read()
+        query = urlencode({"tta": tta, "postprocess": postprocess, "refine": refine, "output": "all", "format": "png"})
+        payload = json.loads(self._request("POST", "/colorize?" + query, body))
+
+        images = []
+        for name in ("gray", "color", "enhanced"):
+            img = Image.open(io.BytesIO(base64.b64decode(payload[name])))
+            img.load()
+            images.append(img)
+        return tuple(images)
@@ -1,105 +1,361 @@
 #we first need to load the model, then we need to use it to colorize the image, followed by post processing
 
+import os
+import sys
+from functools import lru_cache
+
 import numpy as np
 from PIL import Image
-import tensorflow as tf
-from tensorflow import keras
-import matplotlib.pyplot as plt
 import cv2
 
+#tensorflow, keras and matplotlib are imported inside the functions that need them,
+#so importing this module (or luminance, boost_saturation...) stays fast
+
 
 from .luminance_processing import luminance
 from .saturation_Processing import boost_saturation
 from .advanced_Processing import guided_color_refine
+from .fused_processing import fused_postprocess
+from .refine_processing import REFINE_MODES, guided_rgb_refine, joint_bilateral_merge
+from .image_io import as_pil, read_gray
+from . import metrics
 
-MODEL_PATH = "pseudocolor\colorization_model_faces.keras"
+MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "colorization_model_faces.keras")
 IMG_SIZE = 128
+
+#post processing engines, "classic" is luminance -> boost_saturation -> guided_color_refine
+#"fused" does the same steps on one float lab buffer (see fused_processing.py) and is much faster on big images
+#"tiled" works strip by strip with bounded memory for very large scans (see tiled_processing.py)
+#the chroma refinement of every engine can be picked from REFINE_MODES (see refine_processing.py),
+#"bilateral" is the original one, "guided" and "joint_bilateral" follow the edges of the full size L
+POSTPROCESS_MODES = ("classic", "fused", "tiled")
+
+
+#lookup table of the gamma correction, the same numbers np.power gave per pixel, worked out once
+@lru_cache(maxsize=None)
+def gamma_lut(gamma):
+    arr = np.arange(256, dtype=np.float32) / 255.0
+    arr = np.power(arr, gamma)
+    return np.clip(arr * 255, 0, 255).astype(np.uint8)
+
+
+#lookup table of the contrast change, the same as convertScaleAbs on every gray level
+@lru_cache(maxsize=None)
+def contrast_lut(alpha=1.1, beta=0):
+    return cv2.convertScaleAbs(np.arange(256, dtype=np.uint8), alpha=alpha, beta=beta).ravel()
+
+
 #this function applies gamma correction to an image
 #img is a pil image and gamma is the gamma value
 def gamma_variant(img, gamma):
-    arr = np.array(img).astype(np.float32) / 255.0
-    arr = np.power(arr, gamma)
-    arr = np.clip(arr * 255, 0, 255).astype(np.uint8)
-    return Image.fromarray(arr)
+    return Image.fromarray(cv2.LUT(np.asarray(img), gamma_lut(gamma)))
 
 
 #we load the model here
 #also we calculate a combination of mse and mae loss for model training
 
 def perceptual_loss(y_true, y_pred):
+    import tensorflow as tf
     mse = tf.reduce_mean(tf.square(y_true - y_pred))
     mae = tf.reduce_mean(tf.abs(y_true - y_pred))
     return 0.7 * mse + 0.3 * mae
 
 
-#changes contrast of the image using alpha and beta values which are constant amd effectc the whole image
-def contrast_variant(img, alpha=1.1, beta=0):
-    arr = cv2.convertScaleAbs(np.array(img), alpha=alpha, beta=beta)
-    return Image.fromarray(arr)
-
-#this function does the actual colorizing, post processes the image with thee
-#luminance function defined in luminance_processing.py
-
-#to colorize the photo we first scale it down to 128 * 128 as that is what the model was trained on
-#this is then scaled back up to the original image size
-
-def colorize_image(image_path, model):
-    img = Image.open(image_path)
-    gray_img = img.convert('L')
-
-    W, H = img.size  # original size
-
-    #preprocessing
-    #this is a helper function resizes image, scales it, and adds batch and channel dimension
-    def preprocess(pil_img):
-        g = pil_img.resize((IMG_SIZE, IMG_SIZE), Image.Resampling.LANCZOS)
-        g = np.array(g, dtype=np.float32) / 255.0
-        g = np.expand_dims(g, axis=(0, -1))
-        return g
-
-    variants = []
+#loads the trained keras model, perceptual_loss is needed because the model was saved with it
+def load_model(model_path=MODEL_PATH):
+    from tensorflow import keras
+    return keras.models.load_model(model_path, custom_objects={'perceptual_loss': perceptual_loss})
 
-    #1..original grayscale
-    variants.append(preprocess(gray_img))
 
-    #2.horizontal flip
-    variants.append(preprocess(gray_img.transpose(Image.FLIP_LEFT_RIGHT)))
+#runs one dummy batch through the model so the first real request does not pay for
+#building the predict function
+def warm_up(model):
+    if hasattr(model, "warm_up"):
+        model.warm_up()
+        return
+    run_model(model, np.zeros((1, IMG_SIZE, IMG_SIZE, 1), dtype=np.float32))
 
-    #3.gamma corrected variant
-    arr = np.array(gray_img).astype(np.float32) / 255.0
-    gamma = np.clip((arr ** 0.9) * 255, 0, 255).astype(np.uint8)
-    variants.append(preprocess(Image.fromarray(gamma)))
 
-    variants.append(preprocess(gamma_variant(gray_img, 0.8)))
-    variants.append(preprocess(gamma_variant(gray_img, 1.2)))
-
-    variants.append(preprocess(contrast_variant(gray_img, 1.1)))
-    variants.append(preprocess(contrast_variant(gray_img, 0.9)))
-
-
-    #run model on all variants
-    preds = []
-    for v in variants:
-        pred = model.predict(v, verbose=0)[0]      # (128,128,3)
-        pred = np.clip(pred, 0, 1)
-        preds.append(pred)
-
-    #LAB a/b averaging
-    A_list, B_list = [], []
-
-    for p in preds:
-        #convert to rgb 0-255
-        rgb = (p * 255).astype(np.uint8)
-        #convert to lab
-        lab = cv2.cvtColor(rgb, cv2.COLOR_RGB2LAB).astype(np.float32)
-
-        #store a and b channels
-        A_list.append(lab[:, :, 1])
-        B_list.append(lab[:, :, 2])
-
-    #average a and b channels
-    A_avg = np.mean(A_list, axis=0)
-    B_avg = np.mean(B_list, axis=0)
+#changes contrast of the image using alpha and beta values which are constant amd effectc the whole image
+def contrast_variant(img, alpha=1.1, beta=0):
+    return Image.fromarray(cv2.LUT(np.asarray(img), contrast_lut(alpha, beta)))
+
+#test time augmentation variants
+#every variant only changes gray levels, so each one is a 256 entry lookup table (None keeps the
+#pixels), they are applied to the small 128*128 copy so the cost does not depend on the image size
+TTA_VARIANTS = {
+    "original": None,
+    "flip": None,
+    "gamma_0.9": gamma_lut(0.9),
+    "gamma_0.8": gamma_lut(0.8),
+    "gamma_1.2": gamma_lut(1.2),
+    "contrast_1.1": contrast_lut(1.1),
+    "contrast_0.9": contrast_lut(0.9),
+}
+
+#these variants are mirrored (a view of the small image, no copy), so we flip their predictions back before averaging
+FLIPPED_VARIANTS = {"flip"}
+
+#stages reported to the progress callback of colorize_image, in order
+STAGES = ("decode", "inference", "postprocess")
+
+
+#raised from a progress callback to stop a colorization between stages
+class ColorizationCancelled(Exception):
+    pass
+
+
+#adaptive tta tries the variants in this order (the most useful first) and stops for an image as
+#soon as its predictions agree, see adaptive_chroma
+ADAPTIVE = "adaptive"
+ADAPTIVE_ORDER = ["original", "flip", "gamma_0.9", "contrast_1.1", "gamma_1.2", "contrast_0.9", "gamma_0.8"]
+#mean per pixel variance of the a/b predictions (opencv lab units squared) below which it stops,
+#4 is a standard deviation of 2 levels, which does not show in the image
+ADAPTIVE_THRESHOLD = 4.0
+ADAPTIVE_MIN_VARIANTS = 2
+
+#named sets of variants, "full" is the original 7 variant tta and "none" is the fast mode
+TTA_MODES = {
+    "full": ["original", "flip", "gamma_0.9", "gamma_0.8", "gamma_1.2", "contrast_1.1", "contrast_0.9"],
+    "fast": ["original", "flip"],
+    "none": ["original"],
+    ADAPTIVE: ADAPTIVE_ORDER,
+}
+
+
+#turns a tta mode name or a list of variant names into a list of variant names
+def resolve_tta(tta):
+    if isinstance(tta, str):
+        if tta not in TTA_MODES:
+            raise ValueError(f"unknown tta mode {tta!r}, choose from {sorted(TTA_MODES)}")
+        return list(TTA_MODES[tta])
+
+    names = list(tta)
+    if not names:
+        raise ValueError("tta needs at least one variant")
+    for name in names:
+        if name not in TTA_VARIANTS:
+            raise ValueError(f"unknown tta variant {name!r}, choose from {sorted(TTA_VARIANTS)}")
+    return names
+
+
+#scales the gray image down to the 128*128 uint8 model size
+#reducing_gap first shrinks big images with a fast box reduce, the result stays within one gray
+#level of a plain lanczos resize and it is many times faster on big photos
+def downscale(pil_img):
+    return np.asarray(pil_img.resize((IMG_SIZE, IMG_SIZE), Image.Resampling.LANCZOS, reducing_gap=3.0))
+
+
+#one variant of the small uint8 image, flips are views and the rest go through their lookup table
+def variant_array(small, name):
+    if name in FLIPPED_VARIANTS:
+        small = small[:, ::-1]
+    lut = TTA_VARIANTS[name]
+    return small if lut is None else cv2.LUT(small, lut)
+
+
+#builds all variants of one gray image stacked into a single (N,128,128,1) batch
+#the image is scaled down once and every variant is made from that small copy
+def build_variants(gray_img, tta="full"):
+    return variants_from_small(downscale(gray_img), tta)
+
+
+#same as build_variants for an image that is already the 128*128 uint8 copy (see downscale)
+def variants_from_small(small, tta="full"):
+    names = resolve_tta(tta)
+    batch = np.empty((len(names), IMG_SIZE, IMG_SIZE, 1), dtype=np.float32)
+    for i, name in enumerate(names):
+        np.multiply(variant_array(small, name), 1.0 / 255.0, out=batch[i, :, :, 0], casting="unsafe")
+    return batch, names
+
+
+#runs the model once on a whole batch and gives back (N,128,128,3) in 0-1
+#predict_on_batch reuses the compiled predict function, so we dont pay the
+#predict() setup cost (data adapter, callbacks, progress bar) for every variant
+#model can also be a backend from backends.py, those have predict_batch
+def run_model(model, batch):
+    if hasattr(model, "predict_batch"):
+        preds = model.predict_batch(batch)
+    else:
+        preds = model.predict_on_batch(batch)
+    return np.clip(np.asarray(preds, dtype=np.float32), 0, 1)
+
+
+#the a and b channels of every prediction as a (N,128,128,2) float32 array in opencv lab units
+#names tells us which predictions need to be flipped back
+def variant_chroma(preds, names):
+    n = len(preds)
+    rgb = (preds * 255).astype(np.uint8)
+    for i, name in enumerate(names):
+        if name in FLIPPED_VARIANTS:
+            rgb[i] = rgb[i][:, ::-1]
+
+    #stack all predictions into one tall image so we only call cvtColor once
+    lab = cv2.cvtColor(rgb.reshape(n * IMG_SIZE, IMG_SIZE, 3), cv2.COLOR_RGB2LAB)
+    return lab.reshape(n, IMG_SIZE, IMG_SIZE, 3)[:, :, :, 1:].astype(np.float32)
+
+
+#averages the a and b channels of the predictions of one image
+def average_chroma(preds, names):
+    ab = variant_chroma(preds, names)
+    return ab[:, :, :, 0].mean(axis=0), ab[:, :, :, 1].mean(axis=0)
+
+
+#adaptive tta for several images at once, smalls are their 128*128 uint8 copies (see downscale)
+#the first min_variants variants of ADAPTIVE_ORDER run for every image, then one more variant at a
+#time only for the images whose predictions still disagree, a running mean and variance
+#(welford) of the a/b chroma decides: an image stops once the mean per pixel variance is below
+#threshold, the images that go on share every model call
+#first can be a list of the (A, B) chroma of the first variant of every image when it is already
+#worked out, that variant is then not run again
+#gives back a list of (A_avg, B_avg, variants used), the first variant counts as used
+def adaptive_chroma(smalls, model, threshold=ADAPTIVE_THRESHOLD, min_variants=ADAPTIVE_MIN_VARIANTS, first=None):
+    count = [0] * len(smalls)
+    mean = [None] * len(smalls)
+    m2 = [None] * len(smalls)
+
+    active = list(range(len(smalls)))
+    start, step = 0, max(1, min_variants)
+    if first is not None:
+        for i, (A, B) in enumerate(first):
+            count[i] = 1
+            mean[i] = np.stack([A, B], axis=-1).astype(np.float32)
+            m2[i] = np.zeros_like(mean[i])
+        start, step = 1, max(1, min_variants - 1)
+    while active:
+        names = ADAPTIVE_ORDER[start:start + step]
+        batch = np.concatenate([variants_from_small(smalls[i], names)[0] for i in active])
+        with metrics.timer("inference"):
+            preds = run_model(model, batch)
+        metrics.count("inference_rows", len(batch))
+        ab = variant_chroma(preds, names * len(active))
+
+        k = len(names)
+        for j, i in enumerate(active):
+            for x in ab[j * k:(j + 1) * k]:
+                count[i] += 1
+                if mean[i] is None:
+                    mean[i] = x.copy()
+                    m2[i] = np.zeros_like(x)
+                    continue
+                delta = x - mean[i]
+                mean[i] += delta / count[i]
+                m2[i] += delta * (x - mean[i])
+
+        start += k
+        step = 1
+        if start >= len(ADAPTIVE_ORDER):
+            break
+        active = [i for i in active if count[i] < 2 or float(m2[i].mean()) / (count[i] - 1) > threshold]
+
+    return [(mean[i][:, :, 0], mean[i][:, :, 1], count[i]) for i in range(len(smalls))]
+
+
+#works out the averaged chroma of several images, smalls are their 128*128 uint8 copies (see downscale)
+#the variants of all images go through the model together, tta="adaptive" runs adaptive_chroma
+#gives back a list of (A_avg, B_avg, variants used)
+def chroma_for_smalls(smalls, model, tta="full"):
+    if isinstance(tta, str) and tta == ADAPTIVE:
+        results = adaptive_chroma(smalls, model)
+    else:
+        names = resolve_tta(tta)
+        n = len(names)
+        batch = np.concatenate([variants_from_small(small, names)[0] for small in smalls])
+        with metrics.timer("inference"):
+            preds = run_model(model, batch)
+        metrics.count("inference_rows", len(batch))
+        results = []
+        with metrics.timer("chroma"):
+            for i in range(len(smalls)):
+                A_avg, B_avg = average_chroma(preds[i * n:(i + 1) * n], names)
+                results.append((A_avg, B_avg, n))
+    for _, _, used in results:
+        metrics.count("tta_variants", used)
+    return results
+
+
+#the value that stands for the tta setting in cache keys
+def tta_key(tta):
+    if isinstance(tta, str) and tta == ADAPTIVE:
+        return [ADAPTIVE]
+    return resolve_tta(tta)
+
+
+#the result cache key of an image, everything that changes the output goes in here
+def cache_key(cache, image_path, tta, postprocess, saturation=1.2, bilateral=None, refine="bilateral"):
+    return cache.key(image_path, tta=tta_key(tta), postprocess=postprocess,
+                     saturation=saturation, bilateral=bilateral, refine=refine)
+
+
+#opens an image as a gray pil image, image_path can also be bytes or a file object
+#decoding goes through image_io.read_gray and the pil image shares memory with that array
+def load_gray(image_path):
+    return as_pil(read_gray(image_path))
+
+
+#raises ValueError for a refine mode that is unknown or that the postprocess engine does not support,
+#the command line tools call it on their arguments so a bad combination fails before the first image
+def check_refine(postprocess, refine):
+    if refine not in REFINE_MODES:
+        raise ValueError(f"unknown refine mode {refine!r}, choose from {REFINE_MODES}")
+    if postprocess == "tiled" and refine != "bilateral":
+        raise ValueError("the tiled engine only supports bilateral refinement")
+
+
+#array version of render_outputs, gray is the full size uint8 gray array
+#gives back (color, enhanced) uint8 rgb arrays
+#out can be a (color, enhanced) pair of arrays (or np.memmap) to write the results into,
+#the tiled engine writes into them strip by strip without a full size temporary
+def render_arrays(gray, A_avg, B_avg, postprocess="classic", saturation=1.2, bilateral=None, out=None,
+                  refine="bilateral"):
+    check_refine(postprocess, refine)
+    if postprocess == "fused":
+        if bilateral is None:
+            color, enhanced = fused_postprocess(gray, A_avg, B_avg, saturation=saturation, refine=refine)
+        else:
+            color, enhanced = fused_postprocess(gray, A_avg, B_avg, saturation=saturation, bilateral=bilateral,
+                                                refine=refine)
+    elif postprocess == "tiled":
+        #imported here because tiled_processing itself imports this module
+        from .tiled_processing import tiled_render
+        color_out, enhanced_out = out if out is not None else (None, None)
+        color = tiled_render(gray, A_avg, B_avg, color_out, saturation=1.0, bilateral=None)
+        enhanced = tiled_render(gray, A_avg, B_avg, enhanced_out, saturation=saturation,
+                                bilateral=bilateral or (9, 75, 75))
+        return color, enhanced
+    elif postprocess == "classic":
+        color_img, enhanced_img = _classic_render(as_pil(gray), A_avg, B_avg, saturation, bilateral, refine)
+        color, enhanced = np.asarray(color_img), np.asarray(enhanced_img)
+    else:
+        raise ValueError(f"unknown postprocess mode {postprocess!r}, choose from {POSTPROCESS_MODES}")
+
+    if out is None:
+        return color, enhanced
+    out[0][...] = color
+    out[1][...] = enhanced
+    return out
+
+
+#puts the small averaged a/b chroma on top of the full size gray image
+#and runs the post processing, gives back color and enhanced pil images
+#saturation is the saturation boost, bilateral is (d, sigma_color, sigma_space) of the
+#chroma refinement, None keeps the default of the engine, refine is one of REFINE_MODES
+#nothing here touches the model, so it can re-render kept chroma with new settings
+def render_outputs(gray_img, A_avg, B_avg, postprocess="classic", saturation=1.2, bilateral=None,
+                   refine="bilateral"):
+    if postprocess == "classic":
+        if refine not in REFINE_MODES:
+            raise ValueError(f"unknown refine mode {refine!r}, choose from {REFINE_MODES}")
+        return _classic_render(gray_img, A_avg, B_avg, saturation, bilateral, refine)
+    color, enhanced = render_arrays(np.asarray(gray_img), A_avg, B_avg, postprocess, saturation, bilateral,
+                                    refine=refine)
+    return Image.fromarray(color), Image.fromarray(enhanced)
+
+
+#first step of the classic chain: merges the small chroma with the small L, upscales it
+#and puts the full resolution L back in, gives back the basic color pil image
+def merge_chroma(gray_img, A_avg, B_avg):
+    W, H = gray_img.size  # original size
 
     #get small L channel
     L_small = np.array(gray_img.resize((IMG_SIZE, IMG_SIZE)), dtype=np.float32)
@@ -125,28 +381,283 @@ def colorize_image(image_path, model):
 
     #convert back to rgb
     rgb_final = cv2.cvtColor(lab_big.astype(np.uint8), cv2.COLOR_LAB2RGB)
-    color_img = Image.fromarray(rgb_final)
+    return Image.fromarray(rgb_final)
+
+
+#the original post processing chain: lab merge and upscale, luminance, boost_saturation, guided_color_refine
+#refine="guided" swaps the last bilateral filter for the guided filter, "joint_bilateral" builds the
+#enhanced image straight from the small chroma, so the upscale and the refinement are one step
+def _classic_render(gray_img, A_avg, B_avg, saturation=1.2, bilateral=None, refine="bilateral"):
+    color_img = merge_chroma(gray_img, A_avg, B_avg)
+
+    if refine == "joint_bilateral":
+        enhanced_img = joint_bilateral_merge(np.asarray(gray_img), A_avg, B_avg)
+        return color_img, boost_saturation(enhanced_img, factor=saturation)
 
     # ---------- post-processing ----------
     #enhance luminance
     enhanced_img = luminance(color_img, gray_img)
     #boost saturation
-    enhanced_img1 = boost_saturation(enhanced_img, factor=1.2)
+    enhanced_img1 = boost_saturation(enhanced_img, factor=saturation)
     #apply guided color refine
-    guided_filter = guided_color_refine(enhanced_img1)
+    if refine == "guided":
+        guided_filter = guided_rgb_refine(enhanced_img1, np.asarray(gray_img))
+    elif bilateral is None:
+        guided_filter = guided_color_refine(enhanced_img1)
+    else:
+        guided_filter = guided_color_refine(enhanced_img1, *bilateral)
+
+    return color_img, guided_filter
+
+
+#runs only the model part of the colorization and gives back (gray, A_avg, B_avg)
+#the averaged 128*128 a/b chroma is all post processing needs, with a ChromaCache
+#(chroma_cache.py) it is kept so the model only runs once per image
+#progress is an optional callback called with each stage name before it starts
+#stats is an optional dict, "variants" is set to the number of tta variants the model ran
+#(0 when the chroma came from the cache), with tta="adaptive" that is often fewer than 7
+#every step is timed with metrics.timer (see metrics.py)
+def predict_chroma(image_path, model, tta="full", chroma_cache=None, progress=None, stats=None):
+    if progress is not None:
+        progress("decode")
+    with metrics.timer("decode"):
+        gray_img = load_gray(image_path)
+
+    key = None
+    if chroma_cache is not None:
+        key = chroma_cache.key(image_path, tta_key(tta))
+        chroma = chroma_cache.get(key)
+        if chroma is not None:
+            metrics.count("chroma_cache_hits")
+            if stats is not None:
+                stats["variants"] = 0
+            return gray_img, chroma[0], chroma[1]
+
+    if model is None:
+        raise KeyError(f"no cached chroma for {image_path} and no model to compute it")
+
+    with metrics.timer("variants"):
+        small = downscale(gray_img)
+    if progress is not None:
+        progress("inference")
+    #all variants go through the model in one call (or a few with adaptive tta), then LAB a/b averaging
+    (A_avg, B_avg, used), = chroma_for_smalls([small], model, tta)
+    if stats is not None:
+        stats["variants"] = used
+
+    if chroma_cache is not None:
+        chroma_cache.put(key, A_avg, B_avg)
+    return gray_img, A_avg, B_avg
+
+
+#this function does the actual colorizing, post processes the image with thee
+#luminance function defined in luminance_processing.py
+
+#to colorize the photo we first scale it down to 128 * 128 as that is what the model was trained on
+#this is then scaled back up to the original image size
+
+#tta picks the augmentation set, either a name from TTA_MODES or a list of variant names
+#"none" runs only the original image and is the fastest, "adaptive" stops adding variants once
+#their predictions agree (see adaptive_chroma)
+#postprocess picks the post processing engine from POSTPROCESS_MODES, saturation and bilateral
+#are its settings (see render_outputs)
+#cache is an optional ResultCache (result_cache.py), a cached image skips the model completely
+#chroma_cache is an optional ChromaCache, with it new post processing settings dont re-run the model
+#refine picks the chroma refinement from REFINE_MODES
+#progress is an optional callback called with each name in STAGES before that stage starts,
+#it can raise ColorizationCancelled to stop the work
+#stats works like in predict_chroma
+def colorize_image(image_path, model, tta="full", postprocess="classic", cache=None,
+                   chroma_cache=None, saturation=1.2, bilateral=None, progress=None, refine="bilateral",
+                   stats=None):
+    if cache is not None:
+        key = cache_key(cache, image_path, tta, postprocess, saturation, bilateral, refine)
+        cached = cache.get(key)
+        if cached is not None:
+            metrics.count("result_cache_hits")
+            if stats is not None:
+                stats["variants"] = 0
+            return cached
+
+    gray_img, A_avg, B_avg = predict_chroma(image_path, model, tta, chroma_cache, progress, stats)
+
+    if progress is not None:
+        progress("postprocess")
+    with metrics.timer("postprocess"):
+        color_img, guided_filter = render_outputs(gray_img, A_avg, B_avg, postprocess, saturation, bilateral,
+                                                  refine)
+    metrics.count("images")
+
+    if cache is not None:
+        cache.put(key, (gray_img, color_img, guided_filter))
 
     #return gray, color, enhanced
     return gray_img, color_img, guided_filter
 
+
+#full resolution render of only one output, "color" or "enhanced", for when just one of them is
+#needed (for example the one the user saves), the color output of the classic chain is only the
+#merge step, so it skips the post processing
+def render_single_output(gray_img, A_avg, B_avg, output="enhanced", postprocess="classic", saturation=1.2,
+                         bilateral=None, refine="bilateral"):
+    if output == "color" and postprocess == "classic":
+        return merge_chroma(gray_img, A_avg, B_avg)
+    color_img, enhanced_img = render_outputs(gray_img, A_avg, B_avg, postprocess, saturation, bilateral, refine)
+    return color_img if output == "color" else enhanced_img
+
+
+#progressive colorization for previews, every step is rendered on a copy of the gray image fitted
+#into preview_size (w, h) and handed to show(stage, (gray, color, enhanced)) as soon as it is ready:
+#   "quick"    only the first tta variant, its chroma upscaled without post processing
+#   "tta"      the averaged chroma of all tta variants, the first one is not run again
+#   "refined"  the full post processing on the preview sized image
+#with a chroma_cache hit only "refined" is shown, with tta="none" there is no "tta" step
+#gives back (gray_img, A_avg, B_avg) with the full size gray, render_single_output builds the full
+#resolution result from it when it is really needed
+#progress and the other settings work like in colorize_image
+def colorize_progressive(image_path, model, preview_size, show, tta="full", postprocess="classic",
+                         chroma_cache=None, saturation=1.2, bilateral=None, refine="bilateral", progress=None):
+    if progress is not None:
+        progress("decode")
+    with metrics.timer("decode"):
+        gray_img = load_gray(image_path)
+    preview = gray_img.copy()
+    preview.thumbnail(preview_size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+    chroma = None
+    if chroma_cache is not None:
+        key = chroma_cache.key(image_path, tta_key(tta))
+        chroma = chroma_cache.get(key)
+        if chroma is not None:
+            metrics.count("chroma_cache_hits")
+
+    if chroma is None:
+        names = resolve_tta(tta)
+        with metrics.timer("variants"):
+            small = downscale(gray_img)
+        if progress is not None:
+            progress("inference")
+        (A_avg, B_avg, _), = chroma_for_smalls([small], model, names[:1])
+        quick = merge_chroma(preview, A_avg, B_avg)
+        show("quick", (preview, quick, quick))
+
+        if isinstance(tta, str) and tta == ADAPTIVE:
+            (A_avg, B_avg, used), = adaptive_chroma([small], model, first=[(A_avg, B_avg)])
+            #the first variant is already counted by the quick step
+            metrics.count("tta_variants", used - 1)
+        elif len(names) > 1:
+            #the mean of all variants from the first one and the mean of the others
+            (A_rest, B_rest, n), = chroma_for_smalls([small], model, names[1:])
+            A_avg = (A_avg + n * A_rest) / (n + 1)
+            B_avg = (B_avg + n * B_rest) / (n + 1)
+        if len(names) > 1:
+            full = merge_chroma(preview, A_avg, B_avg)
+            show("tta", (preview, full, full))
+        chroma = (A_avg, B_avg)
+        if chroma_cache is not None:
+            chroma_cache.put(key, A_avg, B_avg)
+
+    if progress is not None:
+        progress("postprocess")
+    with metrics.timer("postprocess"):
+        color_img, enhanced_img = render_outputs(preview, chroma[0], chroma[1], postprocess, saturation,
+                                                 bilateral, refine)
+    show("refined", (preview, color_img, enhanced_img))
+    metrics.count("images")
+    return gray_img, chroma[0], chroma[1]
+
+
+#array native colorization, gray is a 2d uint8 array (for example from image_io.read_gray,
+#which can be a read only memory map) and nothing is copied into PIL on the way
+#gives back (gray, color, enhanced) arrays, out works like in render_arrays
+def colorize_array(gray, model, tta="full", postprocess="fused", saturation=1.2, bilateral=None, out=None,
+                   refine="bilateral"):
+    with metrics.timer("variants"):
+        small = downscale(as_pil(gray))
+    (A_avg, B_avg, _), = chroma_for_smalls([small], model, tta)
+    with metrics.timer("postprocess"):
+        color, enhanced = render_arrays(gray, A_avg, B_avg, postprocess, saturation, bilateral, out, refine)
+    metrics.count("images")
+    return gray, color, enhanced
+
+
+#rebuilds the full resolution outputs of an image from its kept chroma with new post processing
+#settings, the model is not needed, raises KeyError if the chroma of the image was never computed
+def rerender(image_path, chroma_cache, tta="full", postprocess="fused", saturation=1.2, bilateral=None,
+             refine="bilateral"):
+    return colorize_image(image_path, None, tta, postprocess, chroma_cache=chroma_cache,
+                          saturation=saturation, bilateral=bilateral, refine=refine)
+
+
+#colorizes many images, the tta variants of batch_size images are packed into one model call
+#this is a generator, it gives back (path, gray, color, enhanced) as soon as each batch is done
+#so the caller can write results while the rest is still being processed
+#with a cache, cached images are given back right away and only new ones go through the model
+#on_error(path, error) is called for an image that can not be read and that image is skipped,
+#without it the error is raised and the run stops
+def colorize_batch(paths, model, batch_size=8, tta="full", postprocess="classic", cache=None, refine="bilateral",
+                   on_error=None):
+    if batch_size < 1:
+        raise ValueError("batch_size must be at least 1")
+
+    resolve_tta(tta)
+    pending = []
+
+    def flush():
+        chroma = chroma_for_smalls([small for _, _, small, _ in pending], model, tta)
+        for (path, gray_img, _, key), (A_avg, B_avg, _) in zip(pending, chroma):
+            with metrics.timer("postprocess"):
+                color_img, enhanced = render_outputs(gray_img, A_avg, B_avg, postprocess, refine=refine)
+            metrics.count("images")
+            if cache is not None:
+                cache.put(key, (gray_img, color_img, enhanced))
+            yield path, gray_img, color_img, enhanced
+        pending.clear()
+
+    for path in paths:
+        key = cached = None
+        try:
+            if cache is not None:
+                key = cache_key(cache, path, tta, postprocess, refine=refine)
+                cached = cache.get(key)
+            if cached is None:
+                with metrics.timer("decode"):
+                    gray_img = load_gray(path)
+                with metrics.timer("variants"):
+                    small = downscale(gray_img)
+        except Exception as e:
+            if on_error is None:
+                raise
+            metrics.count("images_failed")
+            on_error(path, e)
+            continue
+
+        if cached is not None:
+            metrics.count("result_cache_hits")
+            yield (path,) + cached
+            continue
+        pending.append((path, gray_img, small, key))
+        if len(pending) >= batch_size:
+            yield from flush()
+
+    if pending:
+        yield from flush()
+
     
 def main():
     #we first load the model
     #this is the main function to test colorization
-    #it loads the model, processes an example image, and shows the results
-    model = keras.models.load_model(MODEL_PATH, custom_objects={'perceptual_loss': perceptual_loss})
+    #it loads the model, processes an example image (or the one given on the command line), and shows the results
+    import matplotlib.pyplot as plt
+    from .backends import load_backend
+
+    model = load_backend(MODEL_PATH)
     print("✅ Model loaded!")
     
-    img_path = r"pseudocolor\test_images\greyscale_car_2.JPG"
+    if len(sys.argv) > 1:
+        img_path = sys.argv[1]
+    else:
+        img_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_images", "grayscale_face_4.jpg")
     print("processing image")
     
     gray, color, enhanced = colorize_image(img_path, model)
@@ -0,0 +1,126 @@
+#exports the keras model to faster cpu runtimes and checks the result against the original
+#   savedmodel: frozen tf.function compiled with XLA (jit_compile)
+#   tflite:     tflite flatbuffer, optionally float16 or int8 quantized
+#int8 quantization is calibrated on the tta variants of the images in --calibration-dir
+#after exporting, the parity check runs both models on the same images and reports the
+#largest difference of the averaged a/b chroma (in opencv lab units, 0-255)
+#example:
+#   python -m pseudocolor.export_model model.tflite --format tflite --quantize int8
+#   python -m pseudocolor.export_model model_xla --format savedmodel
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+from .backends import load_backend
+from .batch_colorize import find_images
+from .colorization import IMG_SIZE, MODEL_PATH, average_chroma, build_variants, load_gray, load_model, run_model
+
+QUANTIZE_MODES = ("none", "float16", "int8")
+CALIBRATION_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_images")
+
+
+#wraps the keras model into a tf.function with a fixed input signature
+def _serving_function(model, batch_size=None, jit_compile=True):
+    import tensorflow as tf
+
+    @tf.function(input_signature=[tf.TensorSpec([batch_size, IMG_SIZE, IMG_SIZE, 1], tf.float32)],
+                 jit_compile=jit_compile)
+    def serve(x):
+        return {"ab": model(x, training=False)}
+
+    return serve
+
+
+#saves an XLA compiled serving function, load it with backends.SavedModelBackend
+def export_savedmodel(model, out_dir, jit_compile=True):
+    import tensorflow as tf
+
+    module = tf.Module()
+    module.model = model
+    module.serve = _serving_function(model, jit_compile=jit_compile)
+    tf.saved_model.save(module, out_dir, signatures={"serving_default": module.serve})
+    return out_dir
+
+
+#gives the model input batches of the calibration images, one per tta variant
+def calibration_batches(image_paths, tta="full"):
+    for path in image_paths:
+        batch, _ = build_variants(load_gray(path), tta)
+        for variant in batch:
+            yield [variant[np.newaxis]]
+
+
+#converts to tflite, quantize is one of QUANTIZE_MODES
+#int8 needs calibration images, the input and output stay float32 so the backend is a drop in
+def export_tflite(model, out_path, quantize="none", calibration_paths=None):
+    import tensorflow as tf
+
+    serve = _serving_function(model, batch_size=1, jit_compile=False)
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([serve.get_concrete_function()], model)
+
+    if quantize == "float16":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantize == "int8":
+        if not calibration_paths:
+            raise ValueError("int8 quantization needs calibration images")
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: calibration_batches(calibration_paths)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8,
+                                               tf.lite.OpsSet.TFLITE_BUILTINS]
+    elif quantize != "none":
+        raise ValueError(f"unknown quantize mode {quantize!r}, choose from {QUANTIZE_MODES}")
+
+    with open(out_path, "wb") as f:
+        f.write(converter.convert())
+    return out_path
+
+
+#runs the reference model and the exported backend on the same images and compares the chroma
+#gives back a dict with the max and mean a/b error over all pixels of all images
+def parity_check(reference, backend, image_paths, tta="full"):
+    max_error = 0.0
+    total_error = 0.0
+    for path in image_paths:
+        batch, names = build_variants(load_gray(path), tta)
+        A_ref, B_ref = average_chroma(run_model(reference, batch), names)
+        A_new, B_new = average_chroma(run_model(backend, batch), names)
+        error = np.maximum(np.abs(A_ref - A_new), np.abs(B_ref - B_new))
+        max_error = max(max_error, float(error.max()))
+        total_error += float(error.mean())
+
+    return {
+        "images": len(image_paths),
+        "max_chroma_error": max_error,
+        "mean_chroma_error": total_error / len(image_paths) if image_paths else 0.0,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="export the colorization model to a faster cpu runtime")
+    parser.add_argument("output", help="output .tflite file or saved model folder")
+    parser.add_argument("--model", default=MODEL_PATH, help="path of the .keras model file")
+    parser.add_argument("--format", default="tflite", choices=("tflite", "savedmodel"))
+    parser.add_argument("--quantize", default="none", choices=QUANTIZE_MODES, help="tflite quantization")
+    parser.add_argument("--calibration-dir", default=CALIBRATION_DIR, help="images for int8 calibration and parity")
+    parser.add_argument("--no-xla", action="store_true", help="do not jit compile the saved model")
+    args = parser.parse_args(argv)
+
+    model = load_model(args.model)
+    images = find_images(args.calibration_dir)
+
+    if args.format == "savedmodel":
+        export_savedmodel(model, args.output, jit_compile=not args.no_xla)
+    else:
+        export_tflite(model, args.output, args.quantize, images)
+    print(f"exported {args.output}")
+
+    report = parity_check(model, load_backend(args.output), images)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
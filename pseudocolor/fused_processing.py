@@ -0,0 +1,72 @@
+import numpy as np
+import cv2
+
+from .refine_processing import guided_chroma_refine, joint_bilateral_upsample
+
+#fused post processing, does the same job as the classic chain in colorization.render_outputs
+#(lab merge + upscale, luminance, boost_saturation, guided_color_refine) but keeps one float
+#lab buffer from the model chroma to the final image instead of many color space round trips
+
+#the classic chain works in opencv uint8 lab (L 0-255, a/b shifted by 128)
+#here we use float lab (L 0-100, a/b around 0) so nothing gets cut to uint8 in between
+L_SCALE = 100.0 / 255.0
+
+
+#smooths the small a/b chroma with an edge preserving filter
+#the chroma comes from a 128*128 model output, so smoothing it before upscaling costs almost nothing
+def smooth_chroma(ab_small, d=5, sigma_color=75, sigma_space=75):
+    out = np.empty_like(ab_small)
+    for c in range(2):
+        out[:, :, c] = cv2.bilateralFilter(np.ascontiguousarray(ab_small[:, :, c]), d, sigma_color, sigma_space)
+    return out
+
+
+#turns the float lab buffer into a uint8 rgb image, rgb is a float buffer that gets reused
+def _lab_to_rgb8(lab, rgb):
+    cv2.cvtColor(lab, cv2.COLOR_Lab2RGB, dst=rgb)
+    np.clip(rgb, 0.0, 1.0, out=rgb)
+    rgb *= 255.0
+    rgb += 0.5
+    return rgb.astype(np.uint8)
+
+
+#gray is the full size uint8 gray array, A_avg and B_avg are the averaged 128*128 model chroma (uint8 lab units)
+#saturation scales the a/b chroma, which is what raising hsv saturation does to a color in lab
+#bilateral is (d, sigma_color, sigma_space) of the chroma smoothing, None turns smoothing off
+#refine picks how the enhanced chroma is refined (see refine_processing.py), "bilateral" smooths the
+#small chroma before the upscale, "guided" filters the upscaled chroma with L as guide and
+#"joint_bilateral" upsamples and refines in one step, bilateral is only used by "bilateral"
+#gives back (color, enhanced) as uint8 rgb arrays
+def fused_postprocess(gray, A_avg, B_avg, saturation=1.2, bilateral=(5, 75, 75), refine="bilateral"):
+    H, W = gray.shape
+
+    #small a/b chroma centred on 0
+    ab_small = np.empty((A_avg.shape[0], A_avg.shape[1], 2), dtype=np.float32)
+    ab_small[:, :, 0] = A_avg
+    ab_small[:, :, 1] = B_avg
+    ab_small -= 128.0
+
+    #the one full size lab buffer, L is the full resolution gray image
+    lab = np.empty((H, W, 3), dtype=np.float32)
+    np.multiply(gray, L_SCALE, out=lab[:, :, 0], casting="unsafe")
+
+    #basic color: upscaled chroma on the full size L
+    ab = cv2.resize(ab_small, (W, H), interpolation=cv2.INTER_CUBIC)
+    lab[:, :, 1:] = ab
+    rgb = np.empty_like(lab)
+    color = _lab_to_rgb8(lab, rgb)
+
+    #enhanced: smoothed and saturated chroma, the ab and rgb buffers are reused
+    if refine == "bilateral" and bilateral is not None:
+        ab_small = smooth_chroma(ab_small, *bilateral)
+    ab_small *= saturation
+    if refine == "joint_bilateral":
+        ab = joint_bilateral_upsample(ab_small, gray)
+    else:
+        cv2.resize(ab_small, (W, H), dst=ab, interpolation=cv2.INTER_CUBIC)
+        if refine == "guided":
+            ab = guided_chroma_refine(ab, gray)
+    lab[:, :, 1:] = ab
+    enhanced = _lab_to_rgb8(lab, rgb)
+
+    return color, enhanced
@@ -0,0 +1,97 @@
+#array native image input and output
+#the core works on numpy arrays, PIL is only a thin wrapper at the edges:
+#   - files are memory mapped and decoded straight from the map (no read into a bytes copy)
+#   - bytes, bytearray, memoryview and BytesIO are decoded through the buffer protocol
+#   - .npy files are opened as read only memory maps, so they are never loaded as a whole
+#   - .npy outputs are written through memory maps
+#the gray image is decoded directly as 8 bit gray, for jpeg that skips the color conversion too
+
+import io
+import os
+
+import numpy as np
+import cv2
+from PIL import Image
+
+#same as PIL, the orientation tag is ignored so results match Image.open(...).convert('L')
+_DECODE_FLAGS = cv2.IMREAD_GRAYSCALE | cv2.IMREAD_IGNORE_ORIENTATION
+
+
+#turns an array into a 2d uint8 gray array, 2d uint8 input is given back as it is (no copy)
+def _to_gray(arr):
+    if arr.dtype != np.uint8:
+        raise ValueError(f"expected a uint8 image, got {arr.dtype}")
+    if arr.ndim == 2:
+        return arr
+    if arr.ndim == 3 and arr.shape[2] == 3:
+        return cv2.cvtColor(np.ascontiguousarray(arr), cv2.COLOR_RGB2GRAY)
+    if arr.ndim == 3 and arr.shape[2] == 1:
+        return arr[:, :, 0]
+    raise ValueError(f"expected a (H,W) or (H,W,3) image, got shape {arr.shape}")
+
+
+#reads a gray uint8 array from a path, bytes like object, file object or array
+def read_gray(source):
+    if isinstance(source, np.ndarray):
+        return _to_gray(source)
+
+    path = None
+    if isinstance(source, (str, os.PathLike)):
+        path = os.fspath(source)
+        if path.lower().endswith(".npy"):
+            return _to_gray(np.load(path, mmap_mode="r"))
+        if os.path.getsize(path) == 0:
+            raise ValueError(f"empty image file: {path}")
+        data = np.memmap(path, dtype=np.uint8, mode="r")
+    elif hasattr(source, "getbuffer"):
+        data = np.frombuffer(source.getbuffer(), dtype=np.uint8)
+    elif hasattr(source, "read"):
+        data = np.frombuffer(source.read(), dtype=np.uint8)
+    else:
+        data = np.frombuffer(source, dtype=np.uint8)
+
+    gray = cv2.imdecode(data, _DECODE_FLAGS)
+    if gray is None:
+        #formats opencv can not read (gif, some tiff...) go through PIL
+        with Image.open(path if path is not None else io.BytesIO(data.tobytes())) as img:
+            gray = np.asarray(img.convert('L'))
+    return gray
+
+
+#wraps a 2d uint8 array as a PIL "L" image that shares the memory of the array
+def as_pil(gray):
+    gray = np.ascontiguousarray(gray)
+    H, W = gray.shape
+    return Image.frombuffer("L", (W, H), gray, "raw", "L", 0, 1)
+
+
+#gives back an array to write a (H,W,3) uint8 result into
+#for .npy paths it is a memory map of the output file, otherwise a normal array
+def open_output(path, shape):
+    if path.lower().endswith(".npy"):
+        return np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=shape)
+    return np.empty(shape, dtype=np.uint8)
+
+
+#finishes an array from open_output: flushes the memory map or encodes the image file
+def finish_output(path, arr):
+    if isinstance(arr, np.memmap):
+        arr.flush()
+        return
+    write_image(path, arr)
+
+
+#writes an rgb or gray uint8 array, the format comes from the file extension
+def write_image(path, arr):
+    if path.lower().endswith(".npy"):
+        out = open_output(path, arr.shape)
+        out[...] = arr
+        out.flush()
+        return
+    if arr.ndim == 3:
+        arr = cv2.cvtColor(arr, cv2.COLOR_RGB2BGR)
+    ok, encoded = cv2.imencode(os.path.splitext(path)[1], arr)
+    if not ok:
+        raise ValueError(f"could not encode image for {path}")
+    #tofile also works with non ascii paths on windows, unlike cv2.imwrite
+    encoded.tofile(path)
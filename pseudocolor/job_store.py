@@ -0,0 +1,220 @@
+#on disk job store for long batch runs
+#one sqlite file keeps a row per input image: its hash, size and mtime, status (done or failed),
+#output path, seconds, the model version and settings it was made with, the error and how often it
+#was tried
+#the image path is the primary key, so looking up whether an image is done stays fast with
+#millions of rows, status has its own index
+#every run is also written down with its counts and time, so the throughput of past runs can be
+#looked up later
+#writes are committed in groups (commit_every) and the database runs in wal mode, so recording
+#a finished image costs about as much as appending a line to a log file
+#example:
+#   python -m pseudocolor.job_store OUTPUT/.lychee_jobs.sqlite
+#   python -m pseudocolor.job_store OUTPUT/.lychee_jobs.sqlite --failed
+
+import argparse
+import os
+import sqlite3
+import time
+
+from .result_cache import file_hash
+
+JOBS_FILE = ".lychee_jobs.sqlite"
+STATUSES = ("done", "failed")
+
+#how many images are looked up in one query
+LOOKUP_CHUNK = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    image TEXT PRIMARY KEY,
+    input_hash TEXT,
+    size INTEGER,
+    mtime REAL,
+    status TEXT NOT NULL,
+    output TEXT,
+    seconds REAL,
+    model TEXT,
+    settings TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 1,
+    updated REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    finished REAL,
+    model TEXT,
+    done INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    skipped INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+#model is the version of the model (see result_cache.model_version) the images are made with,
+#settings is a string that stands for everything else that changes the output (see
+#parallel_batch.settings_key)
+class JobStore:
+    def __init__(self, path, model=None, settings=None, commit_every=256):
+        self.path = path
+        self.model = model
+        self.settings = settings
+        self.commit_every = commit_every
+        self._uncommitted = 0
+        self._run_id = None
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+    #gives back {image: (status, model, settings, input_hash, size, mtime)} for the images that have a row
+    def lookup(self, images):
+        found = {}
+        images = list(images)
+        for i in range(0, len(images), LOOKUP_CHUNK):
+            chunk = images[i:i + LOOKUP_CHUNK]
+            marks = ",".join("?" * len(chunk))
+            for image, *row in self._db.execute(
+                    f"SELECT image, status, model, settings, input_hash, size, mtime FROM jobs "
+                    f"WHERE image IN ({marks})", chunk):
+                found[image] = tuple(row)
+        return found
+
+    #splits images (a dict of image -> file path) into (todo, skipped): failed is skipped unless
+    #retry_failed, done is skipped when the model, the settings and the file are the same
+    #a file with another size or mtime is hashed and only done again when its content changed
+    def todo(self, images, retry_failed=False):
+        found = self.lookup(images)
+        todo, skipped = [], []
+        for image, path in images.items():
+            row = found.get(image)
+            if row is None:
+                todo.append(image)
+            elif row[0] == "done" and self._same_output(image, path, *row[1:]):
+                skipped.append(image)
+            elif row[0] == "failed" and not retry_failed:
+                skipped.append(image)
+            else:
+                todo.append(image)
+        return todo, skipped
+
+    def _same_output(self, image, path, model, settings, input_hash, size, mtime):
+        if (self.model, self.settings) != (model, settings):
+            return False
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        if (stat.st_size, stat.st_mtime) == (size, mtime):
+            return True
+        if input_hash is None or file_hash(path) != input_hash:
+            return False
+        #same content with a new mtime (for example a copy), the next run does not hash it again
+        self._db.execute("UPDATE jobs SET size = ?, mtime = ? WHERE image = ?",
+                         (stat.st_size, stat.st_mtime, image))
+        return True
+
+    #writes down the result of one image, status is one of STATUSES
+    #size and mtime are the ones of the input file when input_hash was worked out
+    def record(self, image, status, output=None, seconds=None, input_hash=None, error=None, size=None,
+               mtime=None):
+        if status not in STATUSES:
+            raise ValueError(f"unknown job status {status!r}, choose from {STATUSES}")
+        self._db.execute(
+            "INSERT INTO jobs (image, input_hash, size, mtime, status, output, seconds, model, settings, error, "
+            "updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (image) DO UPDATE SET input_hash = excluded.input_hash, size = excluded.size, "
+            "mtime = excluded.mtime, status = excluded.status, output = excluded.output, "
+            "seconds = excluded.seconds, model = excluded.model, settings = excluded.settings, "
+            "error = excluded.error, attempts = attempts + 1, updated = excluded.updated",
+            (image, input_hash, size, mtime, status, output, seconds, self.model, self.settings, error,
+             time.time()))
+        if self._run_id is not None:
+            self._db.execute(f"UPDATE runs SET {status} = {status} + 1 WHERE id = ?", (self._run_id,))
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self._db.commit()
+        self._uncommitted = 0
+
+    #starts a run, the done and failed counts of record() are added to it
+    def start_run(self, skipped=0):
+        cursor = self._db.execute("INSERT INTO runs (started, model, skipped) VALUES (?, ?, ?)",
+                                  (time.time(), self.model, skipped))
+        self._run_id = cursor.lastrowid
+        self.commit()
+        return self._run_id
+
+    def finish_run(self):
+        if self._run_id is not None:
+            self._db.execute("UPDATE runs SET finished = ? WHERE id = ?", (time.time(), self._run_id))
+            self._run_id = None
+        self.commit()
+
+    #number of images per status
+    def counts(self):
+        counts = dict.fromkeys(STATUSES, 0)
+        counts.update(self._db.execute("SELECT status, count(*) FROM jobs GROUP BY status"))
+        return counts
+
+    #images that failed with their error, the newest first
+    def failed(self, limit=None):
+        query = "SELECT image, error, attempts FROM jobs WHERE status = 'failed' ORDER BY updated DESC"
+        if limit is not None:
+            query += f" LIMIT {int(limit)}"
+        return self._db.execute(query).fetchall()
+
+    #past runs with their counts, seconds and images per second, the newest first
+    def runs(self, limit=None):
+        query = "SELECT id, started, finished, model, done, failed, skipped FROM runs ORDER BY id DESC"
+        if limit is not None:
+            query += f" LIMIT {int(limit)}"
+        runs = []
+        for run_id, started, finished, model, done, failed, skipped in self._db.execute(query):
+            seconds = (finished - started) if finished else None
+            runs.append({"id": run_id, "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(started)),
+                         "seconds": round(seconds, 2) if seconds is not None else None, "model": model,
+                         "done": done, "failed": failed, "skipped": skipped,
+                         "images_per_s": round(done / seconds, 3) if seconds else None})
+        return runs
+
+    def close(self):
+        self.commit()
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="show the state of a colorization job store")
+    parser.add_argument("store", help=f"the {JOBS_FILE} file (or the output folder that has it)")
+    parser.add_argument("--failed", action="store_true", help="list the images that failed")
+    parser.add_argument("--runs", type=int, default=5, help="how many past runs to show")
+    args = parser.parse_args(argv)
+
+    path = os.path.join(args.store, JOBS_FILE) if os.path.isdir(args.store) else args.store
+    if not os.path.exists(path):
+        parser.error(f"no job store at {path}")
+    with JobStore(path) as store:
+        counts = store.counts()
+        print(", ".join(f"{n} {status}" for status, n in counts.items()))
+        for run in store.runs(args.runs):
+            rate = "-" if run["images_per_s"] is None else f"{run['images_per_s']:.2f} images/s"
+            print(f"  run {run['id']} {run['started']}: {run['done']} done, {run['failed']} failed, "
+                  f"{run['skipped']} skipped, {rate}")
+        if args.failed:
+            for image, error, attempts in store.failed():
+                print(f"  {image} (tried {attempts}x): {error}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+#optional instrumentation of the pipeline stages
+#the colorization code wraps every step in timer("stage"), that records the seconds into a
+#histogram per stage and tells the observers about it, count("name") adds to a counter
+#everything is off by default and then timer() gives back one shared do-nothing object, so the
+#cost is a flag check per stage; turn it on with enable() or LYCHEE_METRICS=1
+#collect() records the stage times of the calling thread only (for example one gui job), it also
+#works while the global metrics are off
+#the numbers can be read as a dict (snapshot), json or prometheus text (to_prometheus)
+#note: work done in other processes (pipeline.py post processing pool) is not seen here
+#example:
+#   metrics.enable()
+#   colorize_image(path, model)
+#   print(metrics.summary())        {"inference": {"count": 1, "p50_ms": ..., "p95_ms": ...}, ...}
+
+import bisect
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+PREFIX = "lychee"
+
+#histogram bucket upper bounds in seconds, same style as the prometheus client defaults
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+#how many recent values every histogram keeps for the p50/p95 percentiles
+RECENT_VALUES = 1024
+
+_enabled = os.environ.get("LYCHEE_METRICS", "") not in ("", "0")
+_lock = threading.Lock()
+_local = threading.local()
+#number of open collect() blocks over all threads, so the off path does not touch _local
+_collecting = 0
+_counters = {}
+_histograms = {}
+_observers = []
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=RECENT_VALUES)
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            self.bucket_counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+
+    def percentile(self, q):
+        return float(np.percentile(self.recent, q)) if self.recent else 0.0
+
+
+#do-nothing context manager given back by timer() while nothing is recording
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    def __init__(self, stage):
+        self.stage = stage
+        self.seconds = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self._start
+        record(self.stage, self.seconds)
+        return False
+
+
+def enable(on=True):
+    global _enabled
+    _enabled = on
+
+
+def disable():
+    enable(False)
+
+
+def enabled():
+    return _enabled
+
+
+#times the with block as one run of stage
+def timer(stage):
+    if not _enabled and not (_collecting and getattr(_local, "collectors", None)):
+        return _NULL_TIMER
+    return _Timer(stage)
+
+
+#records seconds spent in stage, for times measured somewhere else (for example per image
+#share of a batched model call)
+def record(stage, seconds):
+    for collected in getattr(_local, "collectors", ()):
+        collected[stage] = collected.get(stage, 0.0) + seconds
+    if not _enabled:
+        return
+    with _lock:
+        hist = _histograms.get(stage)
+        if hist is None:
+            hist = _histograms[stage] = Histogram()
+        hist.observe(seconds)
+        observers = list(_observers)
+    for fn in observers:
+        fn(stage, seconds)
+
+
+def count(name, n=1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+#fn(stage, seconds) is called after every timed stage, on the thread that did the work
+def add_observer(fn):
+    with _lock:
+        _observers.append(fn)
+    return fn
+
+
+def remove_observer(fn):
+    with _lock:
+        if fn in _observers:
+            _observers.remove(fn)
+
+
+#records the stage seconds of this thread into the given dict (a new one by default)
+#   with metrics.collect() as timings:
+#       colorize_image(path, model)
+#   timings["inference"]
+@contextmanager
+def collect(timings=None):
+    global _collecting
+    timings = {} if timings is None else timings
+    collectors = getattr(_local, "collectors", None)
+    if collectors is None:
+        collectors = _local.collectors = []
+    collectors.append(timings)
+    with _lock:
+        _collecting += 1
+    try:
+        yield timings
+    finally:
+        collectors.remove(timings)
+        with _lock:
+            _collecting -= 1
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+#per stage count, total seconds and p50/p95 in ms
+def summary():
+    with _lock:
+        return {stage: {
+            "count": hist.count,
+            "total_s": round(hist.sum, 6),
+            "mean_ms": round(1000 * hist.sum / hist.count, 3),
+            "p50_ms": round(1000 * hist.percentile(50), 3),
+            "p95_ms": round(1000 * hist.percentile(95), 3),
+        } for stage, hist in _histograms.items()}
+
+
+def snapshot():
+    stages = summary()
+    with _lock:
+        return {"enabled": _enabled, "counters": dict(_counters), "stages": stages}
+
+
+def to_json(indent=None):
+    return json.dumps(snapshot(), indent=indent)
+
+
+#prometheus text exposition format, stage times are one histogram with a stage label
+def to_prometheus():
+    name = f"{PREFIX}_stage_seconds"
+    lines = [f"# HELP {name} Time spent in each colorization stage.", f"# TYPE {name} histogram"]
+    with _lock:
+        for stage, hist in sorted(_histograms.items()):
+            cumulative = 0
+            for bound, n in zip(hist.buckets, hist.bucket_counts):
+                cumulative += n
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {hist.count}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {hist.sum:.6f}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {hist.count}')
+        for counter, value in sorted(_counters.items()):
+            lines.append(f"# TYPE {PREFIX}_{counter}_total counter")
+            lines.append(f"{PREFIX}_{counter}_total {value}")
+    return "\n".join(lines) + "\n"
+
+
+#prints the summary table, used by the command line tools
+def print_summary():
+    stats = summary()
+    print(f"  {'stage':<14}{'count':>8}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}")
+    for stage, s in stats.items():
+        print(f"  {stage:<14}{s['count']:>8}{s['mean_ms']:>10.2f}{s['p50_ms']:>10.2f}{s['p95_ms']:>10.2f}")
+    with _lock:
+        counters = dict(_counters)
+    for counter, value in sorted(counters.items()):
+        print(f"  {counter}: {value}")
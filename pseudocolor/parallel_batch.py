@@ -0,0 +1,231 @@
+#multi process batch runner for long jobs
+#one python process can not keep all cores busy with the opencv/numpy post processing, so this
+#starts N worker processes, each loads its own model once with its threads pinned (see
+#backends.pin_threads and thread_env) and they all pull the next image from one shared queue, a fast worker
+#simply takes more images
+#every finished image is written to a job store in the output folder (see job_store.py) with its
+#hash, output, time, model version and settings, running the same command again skips what is
+#already done with the same model and settings from an unchanged input, so a crashed or stopped
+#job picks up where it stopped
+#a worker process that dies is replaced, its image is written down as failed
+#example:
+#   python -m pseudocolor.parallel_batch test_images OUTPUT --workers 4
+#   python -m pseudocolor.parallel_batch test_images OUTPUT --workers 4 --retry-failed
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import queue
+import time
+import traceback
+
+from .backends import thread_env
+from .batch_colorize import find_images, output_paths
+from .colorization import MODEL_PATH, POSTPROCESS_MODES, REFINE_MODES, TTA_MODES, check_refine
+from .job_store import JOBS_FILE, JobStore
+from .result_cache import model_version
+
+#message a worker sends when it takes an image, so the runner knows what a dead worker was doing
+_STARTED = "started"
+
+
+def _worker(worker_id, work, results, settings):
+    #imported in the worker so a spawned process only pays for what it uses
+    from .backends import load_backend, pin_threads
+    from .colorization import colorize_image
+    from .result_cache import file_hash
+
+    try:
+        pin_threads(settings["threads"], settings["model"])
+        model = load_backend(settings["model"], num_threads=settings["threads"])
+        model.warm_up()
+    except Exception:
+        results.put(("load_failed", worker_id, None, 0.0, traceback.format_exc(), None))
+        return
+
+    while True:
+        path = work.get()
+        if path is None:
+            break
+        results.put((_STARTED, worker_id, path, 0.0, None, None))
+        start = time.perf_counter()
+        input_hash = stat = None
+        try:
+            #stat before hashing, so a file that changes while it is read looks changed next time
+            stat = os.stat(path)
+            input_hash = file_hash(path)
+            gray, color, enhanced = colorize_image(path, model, settings["tta"], settings["postprocess"],
+                                                   saturation=settings["saturation"],
+                                                   bilateral=settings["bilateral"], refine=settings["refine"])
+            color_path, enhanced_path = output_paths(path, settings["input_dir"], settings["output_dir"])
+            os.makedirs(os.path.dirname(color_path), exist_ok=True)
+            color.save(color_path)
+            enhanced.save(enhanced_path)
+            results.put(("done", worker_id, path, time.perf_counter() - start, None,
+                         (input_hash, color_path, stat.st_size, stat.st_mtime)))
+        except Exception as e:
+            results.put(("failed", worker_id, path, time.perf_counter() - start, str(e),
+                         (input_hash, None, None, None)))
+
+
+#the settings of a run as one string for the job store, images made with other settings are done again
+def settings_key(tta, postprocess, refine, saturation, bilateral):
+    return json.dumps({"tta": tta, "postprocess": postprocess, "refine": refine, "saturation": saturation,
+                       "bilateral": bilateral}, sort_keys=True)
+
+
+#colorizes every image of input_dir with worker processes, see the top of this file
+#threads is the number of threads every worker may use, by default the cores are split evenly
+#gives back a dict with the counts of done, failed and skipped images and the seconds it took
+def run_parallel(input_dir, output_dir, model_path=MODEL_PATH, workers=None, threads=None, tta="full",
+                 postprocess="classic", refine="bilateral", recursive=True, retry_failed=False, saturation=1.2,
+                 bilateral=None):
+    workers = workers or os.cpu_count() or 1
+    threads = threads or max(1, (os.cpu_count() or 1) // workers)
+    os.makedirs(output_dir, exist_ok=True)
+
+    store = JobStore(os.path.join(output_dir, JOBS_FILE), model_version(model_path),
+                     settings_key(tta, postprocess, refine, saturation, bilateral))
+    paths = {os.path.relpath(path, input_dir): path for path in find_images(input_dir, recursive)}
+    todo, skipped = store.todo(paths, retry_failed)
+    todo = [paths[image] for image in todo]
+    skipped = len(skipped)
+
+    settings = {"model": model_path, "threads": threads, "tta": tta, "postprocess": postprocess,
+                "refine": refine, "saturation": saturation, "bilateral": bilateral, "input_dir": input_dir,
+                "output_dir": output_dir}
+
+    #spawn gives every worker a clean interpreter, forking a process with tensorflow loaded is not safe
+    ctx = mp.get_context("spawn")
+    work = ctx.Queue()
+    results = ctx.Queue()
+    #stop markers of workers that died stay in the queue, they must not hold up the exit
+    work.cancel_join_thread()
+    for path in todo:
+        work.put(path)
+
+    def start_worker(worker_id):
+        p = ctx.Process(target=_worker, args=(worker_id, work, results, settings), daemon=True)
+        #a spawned worker imports numpy before _worker runs, so its math library thread counts
+        #must already be in the environment it starts with
+        env = thread_env(threads)
+        saved = {name: os.environ.get(name) for name in env}
+        os.environ.update(env)
+        try:
+            p.start()
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    del os.environ[name]
+                else:
+                    os.environ[name] = value
+        return p
+
+    procs = {i: start_worker(i) for i in range(min(workers, len(todo)))}
+    for _ in procs:
+        work.put(None)
+
+    counts = {"done": 0, "failed": 0, "skipped": skipped}
+    current = {}
+    #workers that took at least one image, so their model loaded
+    started = set()
+    finished = 0
+    next_id = len(procs)
+    start = time.perf_counter()
+
+    store.start_run(skipped)
+    with store:
+        def write(path, status, seconds, error=None, info=None):
+            input_hash, output, size, mtime = info or (None, None, None, None)
+            if output is not None:
+                output = os.path.relpath(output, output_dir)
+            store.record(os.path.relpath(path, input_dir), status, output, round(seconds, 4), input_hash, error,
+                         size, mtime)
+
+        #a model that does not load in one worker will not load in the others either
+        def load_failed(error):
+            for p in procs.values():
+                p.terminate()
+            store.finish_run()
+            raise RuntimeError(f"worker could not load the model:\n{error}")
+
+        while finished < len(todo) and procs:
+            try:
+                status, worker_id, path, seconds, error, info = results.get(timeout=1.0)
+            except queue.Empty:
+                #a worker that died without a word loses its current image, it is written down
+                #as failed and a new worker takes its place
+                for worker_id, p in list(procs.items()):
+                    if p.is_alive():
+                        continue
+                    del procs[worker_id]
+                    if p.exitcode == 0:
+                        continue
+                    #a worker that dies before its first image died loading the model (for example
+                    #an illegal instruction in tensorflow or the oom killer), a new one would too
+                    if worker_id not in started:
+                        load_failed(f"worker died while loading the model (exit code {p.exitcode})")
+                    path = current.pop(worker_id, None)
+                    if path is not None:
+                        write(path, "failed", 0.0, f"worker crashed (exit code {p.exitcode})")
+                        counts["failed"] += 1
+                        finished += 1
+                        print(f"[{finished}/{len(todo)}] worker crashed on {path}")
+                    if finished < len(todo):
+                        procs[next_id] = start_worker(next_id)
+                        work.put(None)
+                        next_id += 1
+                continue
+
+            if status == "load_failed":
+                load_failed(error)
+            if status == _STARTED:
+                current[worker_id] = path
+                started.add(worker_id)
+                continue
+
+            current.pop(worker_id, None)
+            write(path, status, seconds, error, info)
+            counts[status] += 1
+            finished += 1
+            note = f" ({error})" if error else ""
+            print(f"[{finished}/{len(todo)}] {status} {path}{note}")
+        store.finish_run()
+
+    for p in procs.values():
+        p.join()
+    counts["seconds"] = time.perf_counter() - start
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="colorize a folder with several worker processes")
+    parser.add_argument("input_dir", help="folder with grayscale images")
+    parser.add_argument("output_dir", help="folder where the colorized images and the job store are written")
+    parser.add_argument("--model", default=MODEL_PATH, help="model file: .keras, .tflite, .onnx, a saved model folder or stand-in")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="threads per worker for the model and opencv (default: cores / workers)")
+    parser.add_argument("--tta", default="full", choices=sorted(TTA_MODES), help="test time augmentation set")
+    parser.add_argument("--postprocess", default="classic", choices=POSTPROCESS_MODES)
+    parser.add_argument("--refine", default="bilateral", choices=REFINE_MODES)
+    parser.add_argument("--no-recursive", action="store_true", help="only look at the top level of input_dir")
+    parser.add_argument("--retry-failed", action="store_true", help="also redo images that failed in an earlier run")
+    args = parser.parse_args(argv)
+    try:
+        check_refine(args.postprocess, args.refine)
+    except ValueError as e:
+        parser.error(str(e))
+
+    counts = run_parallel(args.input_dir, args.output_dir, args.model, args.workers, args.threads, args.tta,
+                          args.postprocess, args.refine, recursive=not args.no_recursive,
+                          retry_failed=args.retry_failed)
+    done, seconds = counts["done"], counts["seconds"]
+    rate = done / seconds if seconds > 0 else 0.0
+    print(f"colorized {done} images in {seconds:.2f}s ({rate:.2f} images/s), "
+          f"{counts['failed']} failed, {counts['skipped']} already done")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+#streaming colorization pipeline for big jobs
+#the stages run at the same time instead of one after another:
+#   decode + variants  -> thread pool (PIL and numpy release the GIL)
+#   model inference    -> one worker thread that packs images into batches
+#   post processing    -> process pool (luminance, saturation, guided refine)
+#the queues between the stages are bounded, so memory stays the same no matter how many files there are
+
+import multiprocessing as mp
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from .colorization import cache_key, chroma_for_smalls, downscale, load_gray, render_outputs, resolve_tta
+from . import metrics
+
+#marks the end of a queue
+_DONE = object()
+
+
+#carries an exception from a worker thread to the caller
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+#an image that could not be read, it is handed on to the caller in place of its result
+class _ImageFailure:
+    def __init__(self, path, error):
+        self.path = path
+        self.error = error
+
+
+#decode stage, runs in the thread pool, gives back the image and its 128*128 copy
+#a cache hit comes back with the cached outputs instead of the small copy
+def _decode(path, tta, postprocess, refine, cache):
+    try:
+        key = None
+        if cache is not None:
+            key = cache_key(cache, path, tta, postprocess, refine=refine)
+            cached = cache.get(key)
+            if cached is not None:
+                metrics.count("result_cache_hits")
+                return path, cached[0], None, key, cached[1:]
+
+        with metrics.timer("decode"):
+            gray_img = load_gray(path)
+        with metrics.timer("variants"):
+            small = downscale(gray_img)
+    except Exception as e:
+        return _ImageFailure(path, e)
+    return path, gray_img, small, key, None
+
+
+#put that gives up when the pipeline is stopped, so no thread hangs on a full queue
+def _put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+#get that gives back _DONE when the pipeline is stopped
+def _get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _DONE
+
+
+#acquire that gives up when the pipeline is stopped
+def _acquire(sem, stop):
+    while not stop.is_set():
+        if sem.acquire(timeout=0.1):
+            return True
+    return False
+
+
+#colorizes paths with decode, inference and post processing overlapped
+#gives back (path, gray, color, enhanced) in the order the images finish
+#max_pending caps how many images are held between stages at any time
+#cache is an optional ResultCache, cached images skip inference and post processing
+#on_error(path, error) is called for an image that can not be read and that image is skipped,
+#without it the error is raised and the run stops
+def colorize_stream(paths, model, batch_size=8, tta="full", postprocess="classic", cache=None,
+                    decode_workers=4, postprocess_workers=None, max_pending=32, refine="bilateral",
+                    on_error=None):
+    if batch_size < 1:
+        raise ValueError("batch_size must be at least 1")
+    if max_pending < batch_size:
+        raise ValueError("max_pending must be at least batch_size")
+
+    resolve_tta(tta)
+
+    decoded = queue.Queue(maxsize=max_pending)
+    results = queue.Queue()
+    slots = threading.Semaphore(max_pending)
+    stop = threading.Event()
+
+    def producer():
+        try:
+            with ThreadPoolExecutor(max_workers=decode_workers) as pool:
+                #a small window of decode jobs keeps input order and bounds the work in flight
+                window = deque()
+                for path in paths:
+                    if stop.is_set():
+                        break
+                    window.append(pool.submit(_decode, path, tta, postprocess, refine, cache))
+                    if len(window) >= decode_workers * 2:
+                        if not _put(decoded, window.popleft().result(), stop):
+                            break
+                while window and not stop.is_set():
+                    _put(decoded, window.popleft().result(), stop)
+                for f in window:
+                    f.cancel()
+        except BaseException as e:
+            _put(decoded, _Failure(e), stop)
+        _put(decoded, _DONE, stop)
+
+    def inference():
+        try:
+            #spawn, forking while the decode threads run and tensorflow is loaded is not safe
+            with ProcessPoolExecutor(max_workers=postprocess_workers, mp_context=mp.get_context("spawn")) as pool:
+                futures = []
+                finished = False
+                while not finished and not stop.is_set():
+                    #fill one batch, the decode threads are usually ahead of the model
+                    batch = []
+                    while len(batch) < batch_size:
+                        item = _get(decoded, stop)
+                        if item is _DONE:
+                            finished = True
+                            break
+                        if isinstance(item, _Failure):
+                            raise item.error
+                        if isinstance(item, _ImageFailure):
+                            if not _acquire(slots, stop):
+                                return
+                            results.put(item)
+                            continue
+                        path, gray_img, _, key, cached = item
+                        if cached is not None:
+                            if not _acquire(slots, stop):
+                                return
+                            f = Future()
+                            f.set_result(cached)
+                            results.put((path, gray_img, None, f))
+                            continue
+                        batch.append(item)
+                    if not batch:
+                        break
+
+                    chroma = chroma_for_smalls([item[2] for item in batch], model, tta)
+
+                    for (path, gray_img, _, key, _), (A_avg, B_avg, _) in zip(batch, chroma):
+                        if not _acquire(slots, stop):
+                            return
+                        f = pool.submit(render_outputs, gray_img, A_avg, B_avg, postprocess, refine=refine)
+                        f.add_done_callback(lambda f, path=path, gray_img=gray_img, key=key: results.put((path, gray_img, key, f)))
+                        futures.append(f)
+
+                    futures = [f for f in futures if not f.done()]
+                wait(futures)
+        except BaseException as e:
+            results.put(_Failure(e))
+        results.put(_DONE)
+
+    threads = [threading.Thread(target=producer, daemon=True),
+               threading.Thread(target=inference, daemon=True)]
+    for t in threads:
+        t.start()
+
+    try:
+        while True:
+            item = results.get()
+            if item is _DONE:
+                break
+            if isinstance(item, _Failure):
+                raise item.error
+            slots.release()
+            if isinstance(item, _ImageFailure):
+                if on_error is None:
+                    raise item.error
+                metrics.count("images_failed")
+                on_error(item.path, item.error)
+                continue
+            path, gray_img, key, f = item
+            color_img, enhanced = f.result()
+            metrics.count("images")
+            if key is not None:
+                cache.put(key, (gray_img, color_img, enhanced))
+            yield path, gray_img, color_img, enhanced
+    finally:
+        #also runs when the caller stops early, the workers see stop and exit
+        stop.set()
+        for t in threads:
+            t.join()
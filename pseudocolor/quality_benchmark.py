@@ -0,0 +1,225 @@
+#quality against speed benchmark of the pipeline modes
+#every mode (tta set / post processing engine / chroma refinement, optionally @ a model file such as
+#an exported .tflite) runs colorize_image over test_images/ and synthetic images, and gets:
+#   latency      mean and p95 ms per image, and images per second
+#   peak memory  tracemalloc peak of one image (its own pass, tracemalloc is slow)
+#   delta e      CIE76 color difference (LAB, D65) of the enhanced output against the reference
+#                mode, mean over all pixels and the p95 pixel, 0 for the reference itself
+#the modes on the pareto frontier (no other mode is both faster and closer to the reference) are
+#marked in the table and listed in the json report
+#example:
+#   python -m pseudocolor.quality_benchmark --output quality.json
+#   python -m pseudocolor.quality_benchmark --modes full/classic/bilateral none/fused/guided fast/fused/bilateral@model.tflite
+
+import argparse
+import json
+import os
+import time
+import tracemalloc
+
+import numpy as np
+import cv2
+
+from .backends import STAND_IN, load_backend
+from .batch_colorize import find_images
+from .benchmark import TEST_IMAGES, _peak_rss_mb, _percentile, environment, parse_size, synthetic_image
+from .colorization import MODEL_PATH, POSTPROCESS_MODES, TTA_MODES, check_refine, colorize_image
+
+REFERENCE_MODE = "full/classic/bilateral"
+
+DEFAULT_MODES = (
+    "full/classic/bilateral",
+    "full/fused/bilateral",
+    "adaptive/fused/bilateral",
+    "fast/fused/bilateral",
+    "none/fused/bilateral",
+    "fast/fused/guided",
+    "fast/fused/joint_bilateral",
+    "none/fused/joint_bilateral",
+)
+
+
+#"tta/postprocess/refine" or "tta/postprocess/refine@model_path" -> mode dict
+def parse_mode(text, default_model):
+    spec, _, model = text.partition("@")
+    parts = spec.split("/")
+    if len(parts) != 3:
+        raise ValueError(f"mode {text!r} is not tta/postprocess/refine[@model]")
+    tta, postprocess, refine = parts
+    if tta not in TTA_MODES:
+        raise ValueError(f"unknown tta mode {tta!r}, choose from {sorted(TTA_MODES)}")
+    if postprocess not in POSTPROCESS_MODES:
+        raise ValueError(f"unknown postprocess mode {postprocess!r}, choose from {POSTPROCESS_MODES}")
+    check_refine(postprocess, refine)
+    return {"name": text, "tta": tta, "postprocess": postprocess, "refine": refine, "model": model or default_model}
+
+
+#per pixel CIE76 delta e between two rgb uint8 images of the same size
+def delta_e(rgb_a, rgb_b):
+    lab_a = cv2.cvtColor(np.asarray(rgb_a, dtype=np.float32) * (1.0 / 255.0), cv2.COLOR_RGB2LAB)
+    lab_b = cv2.cvtColor(np.asarray(rgb_b, dtype=np.float32) * (1.0 / 255.0), cv2.COLOR_RGB2LAB)
+    lab_a -= lab_b
+    return np.sqrt(np.einsum("ijk,ijk->ij", lab_a, lab_a))
+
+
+#modes that no other mode beats on both speed and quality, lower is better for both keys
+def pareto_front(results, speed="mean_ms", quality="delta_e_mean"):
+    front = []
+    for name, r in results.items():
+        dominated = any(o[speed] <= r[speed] and o[quality] <= r[quality] and
+                        (o[speed] < r[speed] or o[quality] < r[quality])
+                        for other, o in results.items() if other != name)
+        if not dominated:
+            front.append(name)
+    return sorted(front, key=lambda name: results[name][speed])
+
+
+def _colorize(source, model, mode, stats=None):
+    return colorize_image(source, model, mode["tta"], mode["postprocess"], refine=mode["refine"], stats=stats)
+
+
+#runs one mode over inputs (a list of (label, source) pairs), gives back its json friendly result and
+#the enhanced outputs as arrays (the ones of the last repeat)
+def run_mode(mode, inputs, model, repeat=3, memory=True, reference=None):
+    #one untimed run so lazy setup (first model call, opencv init) is not counted
+    _colorize(inputs[0][1], model, mode)
+
+    times = []
+    variants = []
+    outputs = []
+    start = time.perf_counter()
+    for i in range(repeat):
+        outputs = []
+        for _, source in inputs:
+            stats = {}
+            t = time.perf_counter()
+            _, _, enhanced = _colorize(source, model, mode, stats)
+            times.append(time.perf_counter() - t)
+            variants.append(stats.get("variants", 0))
+            outputs.append(np.asarray(enhanced))
+    wall = time.perf_counter() - start
+
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            for _, source in inputs:
+                tracemalloc.reset_peak()
+                base = tracemalloc.get_traced_memory()[0]
+                _colorize(source, model, mode)
+                peak = max(peak or 0, tracemalloc.get_traced_memory()[1] - base)
+        finally:
+            tracemalloc.stop()
+
+    #mean of the per pixel delta e over all images, and the p95 pixel of the worst image
+    de_mean, de_p95 = 0.0, 0.0
+    per_input = {}
+    if reference is not None:
+        pixels = 0
+        for (label, _), out, ref in zip(inputs, outputs, reference):
+            de = delta_e(out, ref)
+            de_mean += float(de.sum())
+            pixels += de.size
+            de_p95 = max(de_p95, float(np.percentile(de, 95)))
+            per_input[label] = round(float(de.mean()), 3)
+        de_mean /= pixels
+
+    images = repeat * len(inputs)
+    result = {
+        "tta": mode["tta"],
+        "postprocess": mode["postprocess"],
+        "refine": mode["refine"],
+        "model": mode["model"],
+        "images": images,
+        "mean_ms": round(1000 * sum(times) / len(times), 3),
+        "p95_ms": round(1000 * _percentile(times, 95), 3),
+        "images_per_s": round(images / wall, 3),
+        "peak_mb": round(peak / 2 ** 20, 2) if peak is not None else None,
+        "mean_variants": round(sum(variants) / len(variants), 2),
+        "delta_e_mean": round(de_mean, 4),
+        "delta_e_p95": round(de_p95, 4),
+        "delta_e_per_input": per_input,
+    }
+    return result, outputs
+
+
+def print_table(report):
+    front = set(report["pareto"])
+    print(f"\nreference: {report['reference']}, {len(report['inputs'])} inputs, {report['repeat']} repeats")
+    print(f"  {'mode':<34}{'mean ms':>10}{'p95 ms':>10}{'img/s':>8}{'peak MB':>9}{'tta':>6}{'dE mean':>9}{'dE p95':>8}  pareto")
+    for name, r in sorted(report["modes"].items(), key=lambda item: item[1]["mean_ms"]):
+        peak = "-" if r["peak_mb"] is None else f"{r['peak_mb']:.1f}"
+        mark = "*" if name in front else ""
+        print(f"  {name:<34}{r['mean_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['images_per_s']:>8.2f}{peak:>9}"
+              f"{r['mean_variants']:>6.1f}{r['delta_e_mean']:>9.3f}{r['delta_e_p95']:>8.2f}  {mark}")
+    print(f"\npeak rss: {report['peak_rss_mb']} MB")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="latency, memory and color difference of the pipeline modes")
+    parser.add_argument("--model", default=None,
+                        help="model for modes without @model (default: the keras model, or the stand-in if it is missing)")
+    parser.add_argument("--modes", nargs="*", default=list(DEFAULT_MODES),
+                        help="modes as tta/postprocess/refine, add @model_path to use another model file")
+    parser.add_argument("--reference", default=REFERENCE_MODE, help="mode the color difference is measured against")
+    parser.add_argument("--images", default=TEST_IMAGES, help="folder of real test images, '' to skip")
+    parser.add_argument("--synthetic", nargs="*", default=["512x512", "2048x1536"],
+                        help="sizes of synthetic images, for example 4000x3000")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-memory", action="store_true", help="skip the (slow) peak memory pass")
+    parser.add_argument("--output", default=None, help="write the json report here")
+    args = parser.parse_args(argv)
+
+    default_model = args.model or (MODEL_PATH if os.path.exists(MODEL_PATH) else STAND_IN)
+    try:
+        reference = parse_mode(args.reference, default_model)
+        modes = [parse_mode(text, default_model) for text in args.modes if text != args.reference]
+    except ValueError as e:
+        parser.error(str(e))
+    if STAND_IN in {mode["model"] for mode in [reference] + modes}:
+        print("using the numpy stand-in model, timings and colors are not the real model's")
+
+    inputs = []
+    if args.images:
+        inputs += [(os.path.basename(p), p) for p in find_images(args.images)]
+    for size in args.synthetic:
+        w, h = parse_size(size)
+        inputs.append((f"synthetic_{w}x{h}", synthetic_image(w, h)))
+    if not inputs:
+        parser.error("no inputs, give --images or --synthetic")
+
+    models = {}
+
+    def model_for(mode):
+        if mode["model"] not in models:
+            models[mode["model"]] = load_backend(mode["model"])
+        return models[mode["model"]]
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "reference": reference["name"],
+        "repeat": args.repeat,
+        "inputs": [label for label, _ in inputs],
+        "environment": environment(),
+        "modes": {},
+    }
+    memory = not args.no_memory
+    print(f"running {reference['name']} (reference)")
+    result, reference_outputs = run_mode(reference, inputs, model_for(reference), args.repeat, memory)
+    report["modes"][reference["name"]] = result
+    for mode in modes:
+        print(f"running {mode['name']}")
+        result, _ = run_mode(mode, inputs, model_for(mode), args.repeat, memory, reference_outputs)
+        report["modes"][mode["name"]] = result
+    report["pareto"] = pareto_front(report["modes"])
+    report["peak_rss_mb"] = _peak_rss_mb()
+
+    print_table(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+#edge preserving chroma refinement engines
+#the model chroma is 128*128, the full size L (gray image) has the real edges, so the refinement
+#lets L decide where the color may change:
+#   "bilateral"        the original refinement, a bilateral filter on a/b (guided_color_refine)
+#   "guided"           guided filter with L as guide, box filter form so the cost per pixel
+#                      does not depend on the radius, run on a subsampled copy (fast guided filter)
+#   "joint_bilateral"  joint bilateral upsampling straight from the 128*128 chroma, the upscale and
+#                      the refinement are one step, weights come from distance and L difference
+#all functions work on float a/b arrays (H,W,2) in any units, gray is the full size uint8 L
+
+import numpy as np
+import cv2
+from PIL import Image
+
+REFINE_MODES = ("bilateral", "guided", "joint_bilateral")
+
+
+#radius of the guided filter when none is given: about one model pixel of the full size image
+def default_radius(shape):
+    return max(4, max(shape) // 128)
+
+
+#guided filter of src (H,W) or (H,W,C) float32 with the gray guide (H,W) float32 in 0-1
+#uses only box filters (He et al.), eps is how big a variance of the guide counts as an edge
+#subsample > 1 works out the filter coefficients on a smaller copy and upsamples them
+#(the fast guided filter), the output keeps the full resolution edges of the guide
+def box_guided_filter(guide, src, radius, eps=1e-3, subsample=1):
+    H, W = guide.shape
+    I, p, r = guide, src, radius
+    if subsample > 1:
+        size = (max(1, W // subsample), max(1, H // subsample))
+        I = cv2.resize(guide, size, interpolation=cv2.INTER_AREA)
+        p = cv2.resize(src, size, interpolation=cv2.INTER_AREA)
+        r = max(1, radius // subsample)
+    ksize = (2 * r + 1, 2 * r + 1)
+    if p.ndim == 3:
+        I3 = I[:, :, np.newaxis]
+    else:
+        I3 = I
+
+    mean_I = cv2.boxFilter(I, -1, ksize)
+    var_I = cv2.boxFilter(I * I, -1, ksize) - mean_I * mean_I
+    mean_p = cv2.boxFilter(p, -1, ksize).reshape(p.shape)
+    cov_Ip = cv2.boxFilter(I3 * p, -1, ksize).reshape(p.shape)
+    if p.ndim == 3:
+        mean_I, var_I = mean_I[:, :, np.newaxis], var_I[:, :, np.newaxis]
+    cov_Ip -= mean_I * mean_p
+
+    a = cov_Ip / (var_I + eps)
+    b = mean_p - a * mean_I
+    a = cv2.boxFilter(a, -1, ksize).reshape(p.shape)
+    b = cv2.boxFilter(b, -1, ksize).reshape(p.shape)
+    if subsample > 1:
+        a = cv2.resize(a, (W, H), interpolation=cv2.INTER_LINEAR).reshape((H, W) + p.shape[2:])
+        b = cv2.resize(b, (W, H), interpolation=cv2.INTER_LINEAR).reshape((H, W) + p.shape[2:])
+
+    if src.ndim == 3:
+        guide = guide[:, :, np.newaxis]
+    a *= guide
+    a += b
+    return a
+
+
+#refines full size a/b (H,W,2) float32 with the guided filter, guided by the full size gray
+def guided_chroma_refine(ab, gray, radius=None, eps=1e-3):
+    radius = radius or default_radius(gray.shape)
+    guide = gray.astype(np.float32)
+    guide *= 1.0 / 255.0
+    return box_guided_filter(guide, ab, radius, eps, subsample=max(1, radius // 4))
+
+
+#joint bilateral upsampling of the small a/b chroma (h,w,2) to the size of gray (H,W)
+#every output pixel is a weighted mean of the (2*radius+1)^2 nearest small chroma pixels,
+#weighted by distance (sigma_spatial in small pixels) and by how close the small L at that pixel
+#is to the full size L (sigma_range in gray levels), so color does not bleed over L edges
+#works in strips of strip_rows rows so the temporaries stay small
+def joint_bilateral_upsample(ab_small, gray, sigma_spatial=1.0, sigma_range=12.0, radius=1, strip_rows=256):
+    h, w = ab_small.shape[:2]
+    H, W = gray.shape
+    planes = [np.ascontiguousarray(ab_small[:, :, c], dtype=np.float32) for c in range(2)]
+    L_small = cv2.resize(gray, (w, h), interpolation=cv2.INTER_AREA)
+
+    #position of every output pixel on the small grid, same pixel centres as cv2.resize
+    xs = (np.arange(W, dtype=np.float32) + 0.5) * (w / W) - 0.5
+    ys = (np.arange(H, dtype=np.float32) + 0.5) * (h / H) - 0.5
+    cx = np.rint(xs).astype(np.intp)
+    cy = np.rint(ys).astype(np.intp)
+
+    #range weights looked up by the absolute L difference, never exactly 0 so no pixel is left without weight
+    range_lut = np.exp(-np.arange(256, dtype=np.float32) ** 2 / (2 * sigma_range ** 2))
+    range_lut = np.maximum(range_lut, 1e-4).astype(np.float32)
+
+    #the small neighbour columns of the output columns come in runs, so they are gathered with
+    #np.repeat (a block copy) instead of fancy indexing
+    offsets = range(-radius, radius + 1)
+    x_taps = []
+    for dx in offsets:
+        nx = np.clip(cx + dx, 0, w - 1)
+        columns, runs = np.unique(nx, return_counts=True)
+        wx = np.exp(-(xs - nx) ** 2 / (2 * sigma_spatial ** 2)).astype(np.float32)
+        x_taps.append((columns, runs, wx))
+
+    out = np.empty((H, W, 2), dtype=np.float32)
+    for y0 in range(0, H, strip_rows):
+        y1 = min(H, y0 + strip_rows)
+        L = np.ascontiguousarray(gray[y0:y1])
+        acc = [np.zeros((y1 - y0, W), dtype=np.float32) for _ in range(2)]
+        total = np.zeros((y1 - y0, W), dtype=np.float32)
+        for dy in offsets:
+            ny = np.clip(cy[y0:y1] + dy, 0, h - 1)
+            wy = np.exp(-(ys[y0:y1] - ny) ** 2 / (2 * sigma_spatial ** 2)).astype(np.float32)
+            for columns, runs, wx in x_taps:
+                weight = cv2.LUT(cv2.absdiff(L, np.repeat(L_small[ny][:, columns], runs, axis=1)), range_lut)
+                weight = cv2.multiply(weight, np.outer(wy, wx))
+                cv2.accumulate(weight, total)
+                for c in range(2):
+                    cv2.accumulateProduct(weight, np.repeat(planes[c][ny][:, columns], runs, axis=1), acc[c])
+        out[y0:y1, :, 0] = acc[0] / total
+        out[y0:y1, :, 1] = acc[1] / total
+    return out
+
+
+#classic chain version of the guided refinement: takes the rgb image (pil or uint8 array) and
+#the full size gray, filters a/b in opencv lab with L as guide, gives back a pil image
+def guided_rgb_refine(img, gray, radius=None, eps=1e-3):
+    lab = cv2.cvtColor(np.asarray(img, dtype=np.uint8), cv2.COLOR_RGB2LAB)
+    ab = guided_chroma_refine(lab[:, :, 1:].astype(np.float32), gray, radius, eps)
+    lab[:, :, 1:] = np.clip(ab + 0.5, 0, 255)
+    return Image.fromarray(cv2.cvtColor(lab, cv2.COLOR_LAB2RGB))
+
+
+#classic chain version of the joint bilateral upsampling: builds the rgb image straight from the
+#128*128 model chroma (opencv lab units) and the full size gray, gives back a pil image
+def joint_bilateral_merge(gray, A_avg, B_avg):
+    ab_small = np.dstack([A_avg, B_avg]).astype(np.float32)
+    lab = np.empty(gray.shape + (3,), dtype=np.uint8)
+    lab[:, :, 0] = gray
+    lab[:, :, 1:] = np.clip(joint_bilateral_upsample(ab_small, gray) + 0.5, 0, 255)
+    return Image.fromarray(cv2.cvtColor(lab, cv2.COLOR_LAB2RGB))
@@ -0,0 +1,153 @@
+#on disk cache for colorized results
+#an entry is keyed by the hash of the input image bytes, the hash of the model file and the
+#post processing parameters, so the same scan with the same settings never goes through the model twice
+#entries are folders with gray.png, color.png and enhanced.png, the least recently used ones are
+#removed when the cache grows over max_bytes
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+from functools import lru_cache
+
+from PIL import Image
+
+OUTPUT_NAMES = ("gray", "color", "enhanced")
+CHUNK_SIZE = 1 << 20
+
+
+#hashes a file in chunks so big scans dont have to fit in memory
+def file_hash(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+#identifies a model in cache keys and job records: the hash of the model file, or the path as it
+#is for a saved model folder or the stand-in
+#hashing a big model file takes a moment, so callers do it on first use and not at startup, and
+#every file is only hashed once
+@lru_cache(maxsize=None)
+def model_version(model_path):
+    if model_path is not None and os.path.isfile(model_path):
+        return file_hash(model_path)
+    return str(model_path)
+
+
+class ResultCache:
+    def __init__(self, cache_dir, model_path=None, max_bytes=512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+        #the model hash is part of every key, so retraining the model invalidates old results
+        self.model_path = model_path
+
+        #key -> [size in bytes, last use time], rebuilt from disk so the cache survives restarts
+        self._entries = {}
+        for key in os.listdir(cache_dir):
+            entry = os.path.join(cache_dir, key)
+            if key.startswith(".") or not os.path.isdir(entry):
+                continue
+            self._entries[key] = [self._entry_size(entry), os.path.getmtime(entry)]
+
+    #worked out on first use and not at startup, see model_version
+    @property
+    def model_id(self):
+        return model_version(self.model_path)
+
+    def _entry_size(self, entry):
+        return sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+
+    #works out the key of an input image and its settings, params must be json friendly
+    def key(self, image_path, **params):
+        h = hashlib.blake2b(digest_size=20)
+        h.update(file_hash(image_path).encode())
+        h.update(self.model_id.encode())
+        h.update(json.dumps(params, sort_keys=True).encode())
+        return h.hexdigest()
+
+    #gives back (gray, color, enhanced) pil images, or None when the result is not cached
+    def get(self, key):
+        entry = os.path.join(self.cache_dir, key)
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries[key][1] = _touch(entry)
+
+        #read without the lock, a put in another thread can evict the entry meanwhile
+        images = []
+        try:
+            for name in OUTPUT_NAMES:
+                with Image.open(os.path.join(entry, name + ".png")) as img:
+                    img.load()
+                images.append(img)
+        except OSError:
+            #evicted while it was read or broken on disk, either way it counts as a miss
+            with self._lock:
+                self.misses += 1
+                if self._entries.pop(key, None) is not None:
+                    shutil.rmtree(entry, ignore_errors=True)
+            return None
+        with self._lock:
+            self.hits += 1
+        return tuple(images)
+
+    #stores the (gray, color, enhanced) pil images of a key and evicts old entries if needed
+    def put(self, key, outputs):
+        #write into a temp folder first so a crash never leaves half an entry behind
+        tmp = os.path.join(self.cache_dir, f".tmp-{uuid.uuid4().hex}")
+        os.makedirs(tmp)
+        for name, img in zip(OUTPUT_NAMES, outputs):
+            img.save(os.path.join(tmp, name + ".png"), compress_level=1)
+        size = self._entry_size(tmp)
+
+        entry = os.path.join(self.cache_dir, key)
+        with self._lock:
+            if key in self._entries:
+                shutil.rmtree(tmp, ignore_errors=True)
+                return
+            os.replace(tmp, entry)
+            self._entries[key] = [size, _touch(entry)]
+            self._evict()
+
+    #removes least recently used entries until the cache fits in max_bytes
+    def _evict(self):
+        total = sum(size for size, _ in self._entries.values())
+        for key in sorted(self._entries, key=lambda k: self._entries[k][1]):
+            if total <= self.max_bytes:
+                break
+            total -= self._entries.pop(key)[0]
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": sum(size for size, _ in self._entries.values()),
+            }
+
+
+#marks an entry as just used, the folder mtime is the lru time
+def _touch(entry):
+    os.utime(entry)
+    return os.path.getmtime(entry)
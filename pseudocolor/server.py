@@ -0,0 +1,176 @@
+#long running colorization server
+#the model is loaded once and kept warm, clients send image bytes over localhost http or a unix socket
+#requests that arrive at the same time are packed into one model call (see batching.py)
+#example:
+#   python -m pseudocolor.server --port 8765
+#   python -m pseudocolor.server --unix /tmp/lychee.sock
+#
+#api:
+#   POST /colorize?tta=full&postprocess=classic&refine=bilateral&output=enhanced&format=png   body = image bytes
+#       output is gray, color, enhanced (image bytes back) or all (json with base64 images)
+#       the X-TTA-Variants header says how many tta variants the model ran (see tta=adaptive)
+#   GET /health   json with model and batching stats
+#   GET /metrics  stage timings and counters as prometheus text (?format=json for json)
+
+import argparse
+import base64
+import io
+import json
+import os
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from . import metrics
+from .backends import load_backend
+from .batching import DynamicBatcher
+from .colorization import (MODEL_PATH, POSTPROCESS_MODES, check_refine, chroma_for_smalls, downscale, load_gray,
+                           render_outputs, resolve_tta, warm_up)
+
+OUTPUT_NAMES = ("gray", "color", "enhanced")
+FORMATS = {"png": ("PNG", "image/png"), "jpeg": ("JPEG", "image/jpeg")}
+
+
+#encodes a pil image to bytes
+def encode_image(img, fmt="png"):
+    buf = io.BytesIO()
+    img.save(buf, format=FORMATS[fmt][0])
+    return buf.getvalue()
+
+
+class ColorizeHandler(BaseHTTPRequestHandler):
+    #set on the server class, see make_server
+    batcher = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/metrics":
+            if parse_qs(url.query).get("format") == ["json"]:
+                self._send(200, "application/json", metrics.to_json().encode())
+            else:
+                self._send(200, "text/plain; version=0.0.4", metrics.to_prometheus().encode())
+            return
+        if url.path != "/health":
+            self.send_error(404)
+            return
+        stats = {"status": "ok"}
+        stats.update(self.batcher.stats())
+        self._send(200, "application/json", json.dumps(stats).encode())
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/colorize":
+            self.send_error(404)
+            return
+
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        output = query.get("output", "enhanced")
+        fmt = query.get("format", "png")
+        postprocess = query.get("postprocess", "classic")
+        refine = query.get("refine", "bilateral")
+        if output not in OUTPUT_NAMES + ("all",) or fmt not in FORMATS:
+            self.send_error(400, "bad output or format")
+            return
+
+        try:
+            #every setting is checked before the model runs, so a bad one costs no inference
+            tta = query.get("tta", "full")
+            resolve_tta(tta)
+            if postprocess not in POSTPROCESS_MODES:
+                raise ValueError(f"unknown postprocess mode {postprocess!r}, choose from {POSTPROCESS_MODES}")
+            check_refine(postprocess, refine)
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            with metrics.timer("decode"):
+                gray_img = load_gray(io.BytesIO(body))
+        except Exception as e:
+            self.send_error(400, str(e))
+            return
+
+        try:
+            with metrics.timer("variants"):
+                small = downscale(gray_img)
+            #the inference time includes the time spent waiting for the batch to fill
+            (A_avg, B_avg, used), = chroma_for_smalls([small], self.batcher, tta)
+            with metrics.timer("postprocess"):
+                color_img, enhanced = render_outputs(gray_img, A_avg, B_avg, postprocess, refine=refine)
+            metrics.count("images")
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+
+        images = dict(zip(OUTPUT_NAMES, (gray_img, color_img, enhanced)))
+        headers = {"X-TTA-Variants": str(used)}
+        if output == "all":
+            payload = {name: base64.b64encode(encode_image(img, fmt)).decode("ascii") for name, img in images.items()}
+            self._send(200, "application/json", json.dumps(payload).encode(), headers)
+        else:
+            self._send(200, FORMATS[fmt][1], encode_image(images[output], fmt), headers)
+
+    def _send(self, code, content_type, data, headers=None):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    #unix socket clients have no address
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "unix"
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        super().server_bind()
+
+
+#builds a server around a loaded model, with unix_socket set it listens there instead of host:port
+#max_batch is counted in model rows (every tta variant of a request is one row)
+def make_server(model, host="127.0.0.1", port=8765, unix_socket=None, max_batch=64, max_wait_ms=5.0):
+    batcher = DynamicBatcher(model, max_batch_size=max_batch, max_wait_ms=max_wait_ms)
+    handler = type("Handler", (ColorizeHandler,), {"batcher": batcher})
+    if unix_socket:
+        return UnixHTTPServer(unix_socket, handler)
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="keep the colorization model loaded and serve requests")
+    parser.add_argument("--model", default=MODEL_PATH, help="model file: .keras, .tflite or an exported saved model folder")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix", default=None, help="listen on this unix socket instead of http host:port")
+    parser.add_argument("--max-batch", type=int, default=64, help="most rows (tta variants) packed into one model call")
+    parser.add_argument("--max-wait-ms", type=float, default=5.0,
+                        help="how long the first request of a batch waits for others to join")
+    parser.add_argument("--no-metrics", action="store_true", help="do not time the stages for GET /metrics")
+    args = parser.parse_args(argv)
+
+    metrics.enable(not args.no_metrics)
+
+    model = load_backend(args.model)
+    warm_up(model)
+    print("model loaded")
+
+    server = make_server(model, args.host, args.port, args.unix, args.max_batch, args.max_wait_ms)
+    print(f"listening on {args.unix or f'http://{args.host}:{args.port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+#small timer for tracking how long startup takes
+#marks are seconds since the start time, the report can be printed or written as json
+#so startup times can be compared between versions
+
+import json
+import threading
+import time
+
+
+class StartupTimer:
+    def __init__(self, start=None):
+        #pass time.perf_counter() taken at the very top of the program to include import time
+        self.start = time.perf_counter() if start is None else start
+        self.marks = []
+        self._lock = threading.Lock()
+
+    def mark(self, name):
+        seconds = time.perf_counter() - self.start
+        with self._lock:
+            self.marks.append((name, seconds))
+        return seconds
+
+    def report(self):
+        with self._lock:
+            return {name: round(seconds, 4) for name, seconds in self.marks}
+
+    #prints the marks and, with a path, also writes them as json
+    def print_report(self, path=None):
+        report = self.report()
+        print("startup timing:")
+        for name, seconds in report.items():
+            print(f"  {name:<24} {seconds * 1000:8.1f} ms")
+        if path:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2)
+        return report
@@ -0,0 +1,137 @@
+#tiled full resolution stage for very large scans
+#the model only gives a 128*128 a/b chroma, so instead of building full size float buffers for the
+#whole image we upsample the chroma, replace L and refine strip by strip
+#every strip is computed with extra overlap rows above and below, so the refinement filter sees the
+#same neighbours as on the whole image and the strips join without seams
+#the working memory is capped by budget_mb no matter how big the image is
+#example:
+#   python -m pseudocolor.tiled_processing scan.tif scan_color.npy --budget-mb 256
+
+import argparse
+
+import numpy as np
+import cv2
+from PIL import Image
+
+from .backends import load_backend
+from .colorization import MODEL_PATH, chroma_for_smalls, downscale
+from .fused_processing import L_SCALE
+from .image_io import as_pil, finish_output, open_output, read_gray
+
+#working bytes per pixel of a strip: remap maps (8), a/b (8), bilateral output (8), lab (12), rgb (12)
+STRIP_BYTES_PER_PIXEL = 48
+
+
+#how many rows fit in one strip for the given width and memory budget
+def strip_rows(width, budget_mb, overlap):
+    rows = int(budget_mb * 1024 * 1024 // (width * STRIP_BYTES_PER_PIXEL)) - 2 * overlap
+    return max(rows, 16)
+
+
+#rows the bilateral filter reads on each side of a pixel, with d <= 0 opencv works the radius
+#out from sigma_space instead
+def filter_radius(bilateral):
+    if bilateral is None:
+        return 0
+    d, _, sigma_space = bilateral
+    return d // 2 if d > 0 else round(1.5 * sigma_space)
+
+
+#bicubic upsampling of the small chroma for rows y0..y1 only
+#uses the same pixel centre mapping as cv2.resize, so every row comes out the same as in a full resize
+def _upsample_rows(ab_small, y0, y1, W, H, xs):
+    ys = (np.arange(y0, y1, dtype=np.float32) + 0.5) * (ab_small.shape[0] / H) - 0.5
+    map_x = np.repeat(xs[np.newaxis, :], y1 - y0, axis=0)
+    map_y = np.repeat(ys[:, np.newaxis], W, axis=1)
+    return cv2.remap(ab_small, map_x, map_y, cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+
+
+#gray is the full size uint8 gray array, A_avg and B_avg the averaged 128*128 model chroma
+#writes a uint8 rgb image into out (any (H,W,3) uint8 array, also a np.memmap) and gives it back
+#saturation scales the a/b chroma, bilateral is (d, sigma_color, sigma_space) of the refinement
+#or None for no refinement, overlap is the number of extra rows on each side of a strip
+def tiled_render(gray, A_avg, B_avg, out=None, saturation=1.2, bilateral=(9, 75, 75),
+                 budget_mb=256, overlap=None):
+    H, W = gray.shape
+    if out is None:
+        out = np.empty((H, W, 3), dtype=np.uint8)
+
+    ab_small = np.empty((A_avg.shape[0], A_avg.shape[1], 2), dtype=np.float32)
+    ab_small[:, :, 0] = A_avg
+    ab_small[:, :, 1] = B_avg
+    ab_small -= 128.0
+    ab_small *= saturation
+
+    if overlap is None:
+        overlap = filter_radius(bilateral)
+    rows = strip_rows(W, budget_mb, overlap)
+    xs = (np.arange(W, dtype=np.float32) + 0.5) * (ab_small.shape[1] / W) - 0.5
+
+    for y0 in range(0, H, rows):
+        y1 = min(H, y0 + rows)
+        h0 = max(0, y0 - overlap)
+        h1 = min(H, y1 + overlap)
+
+        ab = _upsample_rows(ab_small, h0, h1, W, H, xs)
+        if bilateral is not None:
+            for c in range(2):
+                ab[:, :, c] = cv2.bilateralFilter(np.ascontiguousarray(ab[:, :, c]), *bilateral)
+
+        #drop the overlap rows and put the full resolution L under the chroma
+        lab = np.empty((y1 - y0, W, 3), dtype=np.float32)
+        np.multiply(gray[y0:y1], L_SCALE, out=lab[:, :, 0], casting="unsafe")
+        lab[:, :, 1:] = ab[y0 - h0:y1 - h0]
+        del ab
+
+        rgb = cv2.cvtColor(lab, cv2.COLOR_Lab2RGB, dst=lab)
+        np.clip(rgb, 0.0, 1.0, out=rgb)
+        rgb *= 255.0
+        rgb += 0.5
+        out[y0:y1] = rgb
+
+    return out
+
+
+#works out the averaged chroma of a big image
+#the image is scaled down once and the tta variants are made from the 128*128 copy,
+#so the full size image never goes through the variants
+def predict_chroma_small(gray_img, model, tta="full"):
+    (A_avg, B_avg, _), = chroma_for_smalls([downscale(gray_img)], model, tta)
+    return A_avg, B_avg
+
+
+#colorizes a big image with bounded memory and writes it to out_path
+#.npy inputs and outputs go through memory maps (see image_io.py), so neither has to fit in memory,
+#other output formats are encoded at the end, which needs the full output array in memory
+def colorize_tiled(image_path, model, out_path, tta="full", saturation=1.2, bilateral=(9, 75, 75),
+                   budget_mb=256):
+    gray = read_gray(image_path)
+    A_avg, B_avg = predict_chroma_small(as_pil(gray), model, tta)
+
+    out = open_output(out_path, gray.shape + (3,))
+    tiled_render(gray, A_avg, B_avg, out, saturation, bilateral, budget_mb)
+    finish_output(out_path, out)
+    return out_path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="colorize a very large image with bounded memory")
+    parser.add_argument("image", help="grayscale input image")
+    parser.add_argument("output", help="output image, use .npy to write through a memory map")
+    parser.add_argument("--model", default=MODEL_PATH, help="model file: .keras, .tflite or an exported saved model folder")
+    parser.add_argument("--tta", default="full", help="test time augmentation set")
+    parser.add_argument("--saturation", type=float, default=1.2)
+    parser.add_argument("--budget-mb", type=float, default=256, help="working memory for the full resolution stage")
+    args = parser.parse_args(argv)
+
+    #archival scans are bigger than the PIL decompression bomb limit on purpose
+    Image.MAX_IMAGE_PIXELS = None
+
+    model = load_backend(args.model)
+    colorize_tiled(args.image, model, args.output, tta=args.tta, saturation=args.saturation,
+                   budget_mb=args.budget_mb)
+    print(f"written {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+#video and image sequence colorization
+#frames are read one at a time (cv2.VideoCapture or a folder of images), colorized and written
+#straight to a cv2.VideoWriter (or a folder of images), so the clip is never held in memory
+#neighbouring frames look almost the same, so:
+#   - the model only runs when the 128*128 copy of the frame changed by more than change_threshold
+#     gray levels (mean absolute difference) since the last frame that went through the model,
+#     otherwise the chroma of that frame is used again
+#   - the a/b chroma is smoothed over time (exponential moving average), which stops the colors
+#     from flickering, a scene cut (change above cut_threshold) starts the smoothing over
+#example:
+#   python -m pseudocolor.video_colorize clip.mp4 clip_color.mp4 --tta fast
+#   python -m pseudocolor.video_colorize frames_dir out_dir --result color
+
+import argparse
+import os
+
+import numpy as np
+import cv2
+
+from . import metrics
+from .backends import load_backend
+from .batch_colorize import find_images
+from .colorization import (MODEL_PATH, POSTPROCESS_MODES, REFINE_MODES, TTA_MODES, check_refine, chroma_for_smalls,
+                           downscale, render_arrays, resolve_tta)
+from .image_io import as_pil, read_gray, write_image
+
+#video container -> fourcc of the writer
+FOURCC = {".mp4": "mp4v", ".m4v": "mp4v", ".avi": "XVID", ".mov": "mp4v", ".mkv": "XVID"}
+
+
+#gives back the frames of a video file or an image folder one by one as 2d uint8 gray arrays
+def read_frames(source):
+    if os.path.isdir(source):
+        for path in find_images(source, recursive=False):
+            yield read_gray(path)
+        return
+
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise ValueError(f"could not open video {source}")
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            yield frame[:, :, 0] if _is_gray(frame) else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    finally:
+        capture.release()
+
+
+#grayscale videos are usually decoded as three equal channels, those skip the color conversion
+def _is_gray(frame):
+    return np.array_equal(frame[::16, ::16, 0], frame[::16, ::16, 1])
+
+
+#frames per second of a video file, None for image folders or when the file does not say
+def source_fps(source):
+    if os.path.isdir(source):
+        return None
+    capture = cv2.VideoCapture(source)
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    capture.release()
+    return fps or None
+
+
+#colorizes a stream of gray frames, gives back (gray, color, enhanced) uint8 arrays per frame
+#smoothing is the weight of the previous chroma in the moving average, 0 turns it off
+#stats is an optional dict that gets the number of frames and of model runs
+def colorize_frames(frames, model, tta="fast", postprocess="fused", saturation=1.2, refine="bilateral",
+                    change_threshold=2.0, cut_threshold=25.0, smoothing=0.6, stats=None):
+    resolve_tta(tta)
+    stats = {} if stats is None else stats
+    stats.update(frames=0, inferred=0, reused=0, cuts=0)
+
+    key_small = None
+    chroma = None
+    smoothed = None
+
+    for gray in frames:
+        stats["frames"] += 1
+        with metrics.timer("variants"):
+            small = downscale(as_pil(gray))
+        change = np.inf if key_small is None else float(cv2.absdiff(small, key_small).mean())
+
+        if change > change_threshold:
+            (A_avg, B_avg, _), = chroma_for_smalls([small], model, tta)
+            chroma = np.stack([A_avg, B_avg])
+            key_small = small
+            stats["inferred"] += 1
+        else:
+            stats["reused"] += 1
+            metrics.count("frames_reused")
+
+        if change > cut_threshold:
+            if smoothed is not None:
+                stats["cuts"] += 1
+            smoothed = chroma.copy()
+        else:
+            smoothed *= smoothing
+            smoothed += (1.0 - smoothing) * chroma
+
+        with metrics.timer("postprocess"):
+            color, enhanced = render_arrays(gray, smoothed[0], smoothed[1], postprocess, saturation, refine=refine)
+        metrics.count("frames")
+        yield gray, color, enhanced
+
+
+#writes rgb frames to a video file or, when out_path has no video extension, as numbered pngs in
+#the out_path folder, the writer is opened with the size of the first frame and later frames of
+#another size are scaled to it
+class FrameWriter:
+    def __init__(self, out_path, fps=25.0):
+        self.out_path = out_path
+        self.fps = fps
+        self.count = 0
+        self._writer = None
+        self._ext = os.path.splitext(out_path)[1].lower()
+        if self._ext not in FOURCC:
+            os.makedirs(out_path, exist_ok=True)
+
+    def write(self, rgb):
+        if self._ext not in FOURCC:
+            write_image(os.path.join(self.out_path, f"frame_{self.count:06d}.png"), rgb)
+        else:
+            if self._writer is None:
+                H, W = rgb.shape[:2]
+                fourcc = cv2.VideoWriter_fourcc(*FOURCC[self._ext])
+                self._writer = cv2.VideoWriter(self.out_path, fourcc, self.fps, (W, H))
+                if not self._writer.isOpened():
+                    raise ValueError(f"could not open video writer for {self.out_path}")
+                self._size = (W, H)
+            #a video has one frame size, frames of an image folder may not
+            if rgb.shape[1::-1] != self._size:
+                rgb = cv2.resize(rgb, self._size, interpolation=cv2.INTER_AREA)
+            self._writer.write(cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR))
+        self.count += 1
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.release()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+#colorizes a video file or image folder into out_path, output picks the color or enhanced result
+#gives back the stats of colorize_frames
+def colorize_video(source, out_path, model, output="enhanced", fps=None, **options):
+    fps = fps or source_fps(source) or 25.0
+    stats = {}
+    with FrameWriter(out_path, fps) as writer:
+        for gray, color, enhanced in colorize_frames(read_frames(source), model, stats=stats, **options):
+            writer.write(enhanced if output == "enhanced" else color)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="colorize a grayscale video or image sequence")
+    parser.add_argument("source", help="video file or folder of frames")
+    parser.add_argument("output", help="output video (.mp4, .avi...) or folder for png frames")
+    parser.add_argument("--model", default=MODEL_PATH, help="model file: .keras, .tflite, .onnx, a saved model folder or stand-in")
+    parser.add_argument("--tta", default="fast", choices=sorted(TTA_MODES), help="test time augmentation set")
+    parser.add_argument("--postprocess", default="fused", choices=POSTPROCESS_MODES)
+    parser.add_argument("--refine", default="bilateral", choices=REFINE_MODES)
+    parser.add_argument("--result", default="enhanced", choices=("color", "enhanced"),
+                        help="which result goes into the output")
+    parser.add_argument("--fps", type=float, default=None, help="output frame rate (default: the one of the source)")
+    parser.add_argument("--change-threshold", type=float, default=2.0,
+                        help="mean gray level change of the small frame that runs the model again")
+    parser.add_argument("--smoothing", type=float, default=0.6,
+                        help="weight of the previous chroma, higher is steadier color, 0 turns it off")
+    args = parser.parse_args(argv)
+    try:
+        check_refine(args.postprocess, args.refine)
+    except ValueError as e:
+        parser.error(str(e))
+
+    model = load_backend(args.model)
+    stats = colorize_video(args.source, args.output, model, output=args.result, fps=args.fps, tta=args.tta,
+                           postprocess=args.postprocess, refine=args.refine,
+                           change_threshold=args.change_threshold, smoothing=args.smoothing)
+    print(f"{stats['frames']} frames written to {args.output}, model ran on {stats['inferred']}, "
+          f"{stats['reused']} reused, {stats['cuts']} scene cuts")
+
+
+if __name__ == "__main__":
+    main()
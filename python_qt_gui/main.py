@@ -1,28 +1,111 @@
+import time
+#taken before any other import so the startup report includes import time
+START_TIME = time.perf_counter()
+
 import sys
 import os
 from PySide6.QtWidgets import QApplication, QWidget, QFileDialog, QMessageBox
 from PySide6.QtGui import QPixmap, QImage
-from PySide6.QtCore import Qt
+from PySide6.QtCore import Qt, QThreadPool, QTimer
 from main_ui import Ui_Form  
-import cv2 
 import numpy as np  
 from welcome_window import WelcomeWindow
 
 #adding parent directory to module search
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-#this is the path of model .keras file
-MODEL_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'pseudocolor', 'colorization_model_faces.keras'))
+#this is the path of model .keras file, LYCHEE_MODEL can point to an exported model
+#(.tflite, .onnx, saved model folder) or be "stand-in" to try the gui without the model
+MODEL_PATH = os.environ.get('LYCHEE_MODEL') or os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'pseudocolor', 'colorization_model_faces.keras'))
+#results of images that were opened before are kept here so they dont go through the model again
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.lychee_color_cache')
+#the progressive mode keeps the small model chroma of opened images here instead
+CHROMA_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.lychee_color_chroma')
+#the image is shown in steps (quick preview, all tta variants, refined) at the size of the labels and
+#the full resolution image is only made when it is saved, LYCHEE_PROGRESSIVE=0 turns this off and
+#every result is made at full resolution right away like before
+PROGRESSIVE = os.environ.get('LYCHEE_PROGRESSIVE', '1') != '0'
+#when this is set (http://host:port or a unix socket path) the gui asks a running
+#colorization server (pseudocolor/server.py) instead of loading the model itself
+SERVER_ADDRESS = os.environ.get('LYCHEE_SERVER')
+#if set, the startup timing report is also written to this json file
+STARTUP_REPORT = os.environ.get('LYCHEE_STARTUP_REPORT')
+
+from pseudocolor.result_cache import ResultCache
+from pseudocolor.chroma_cache import ChromaCache
+from pseudocolor.client import ColorizeClient
+from pseudocolor.startup_timing import StartupTimer
+from workers import ColorizeWorker, ModelLoader, SaveWorker
+
+#text shown in the window title for each stage of the work
+STAGE_TEXT = {
+    "decode": "reading image",
+    "inference": "running model",
+    "postprocess": "post processing",
+}
+
+#text shown in the window title for each preview step of the progressive mode
+PREVIEW_TEXT = {
+    "quick": "quick preview",
+    "tta": "preview",
+}
+
+#stage times shown in the window title when an image is done
+TIMING_TEXT = {
+    "inference": "model",
+    "server": "server",
+    "postprocess": "post processing",
+}
+
+#this helper changes pil or numpy image into qpixmap
+#numpy arrays are wrapped by the QImage without a copy, the only copy is the one into the pixmap
+def to_qpixmap(img):
+    #pil images are turned into an array once, arrays are used as they are
+    img = np.ascontiguousarray(np.asarray(img))
+
+    #if it is gray image
+    if img.ndim == 2:
+        h, w = img.shape
+        qimg = QImage(img.data, w, h, img.strides[0], QImage.Format_Grayscale8)
+    else:
+        h, w, ch = img.shape
+        qimg = QImage(img.data, w, h, img.strides[0], QImage.Format_RGB888)
+    #the QImage only points at the array memory, fromImage copies it while img is still alive
+    return QPixmap.fromImage(qimg)
+
+
+#short text like " (model 85 ms, post processing 40 ms)" for the window title
+#a cached result has no stage times and gets no text
+def timing_text(timings):
+    parts = [f"{text} {timings[stage] * 1000:.0f} ms" for stage, text in TIMING_TEXT.items() if stage in timings]
+    return f" ({', '.join(parts)})" if parts else ""
 
-from pseudocolor.colorization import colorize_image, perceptual_loss
-from tensorflow import keras
 
 class mywindow(QWidget):
-    def __init__(self):
+    def __init__(self, timer=None):
         super().__init__()
+        self.timer = timer or StartupTimer(START_TIME)
 
-        #load the model for color work
-        self.model = keras.models.load_model(MODEL_PATH, custom_objects={'perceptual_loss': perceptual_loss})
-        print("model loaded")
+        #the model is loaded and warmed up in the background, or the server is used if there is one
+        #tensorflow is only imported by that background load, so the windows show right away
+        self.pool = QThreadPool.globalInstance()
+        self.client = None
+        self.model = None
+        if SERVER_ADDRESS:
+            self.client = ColorizeClient(SERVER_ADDRESS)
+            print("using colorization server", SERVER_ADDRESS)
+        else:
+            loader = ModelLoader(MODEL_PATH, self.timer)
+            loader.signals.loaded.connect(self.on_model_loaded)
+            loader.signals.failed.connect(self.on_model_failed)
+            self.pool.start(loader)
+
+        #cache for results of images that were already colorized
+        #(the progressive mode only keeps the model chroma, the server has its own caches)
+        self.progressive = PROGRESSIVE and self.client is None
+        if self.progressive:
+            self.cache = ChromaCache(CHROMA_CACHE_DIR, model_path=MODEL_PATH)
+        else:
+            self.cache = ResultCache(CACHE_DIR, model_path=MODEL_PATH)
 
         self.ui = Ui_Form()
         self.ui.setupUi(self)
@@ -39,32 +122,101 @@ class mywindow(QWidget):
         self.output_pixmap = None
         self.enhanced_pixmap = None
         self.input_image_path = None
+        #(gray, A_avg, B_avg) of the shown image in the progressive mode, save_output makes the
+        #full resolution image from it
+        self.chroma = None
+
+        #the running job, a newer selection cancels it and its results are ignored
+        self.job_id = 0
+        self.worker = None
+        #every started job by id, so a replaced job stays alive until its thread is done
+        self.jobs = {}
+        #image picked before the model finished loading
+        self.waiting_path = None
+        #full resolution save that is still running
+        self.save_worker = None
+
+    def on_model_loaded(self, model):
+        self.model = model
+        print("model loaded")
+        self.timer.print_report(STARTUP_REPORT)
+        if self.waiting_path is not None:
+            path, self.waiting_path = self.waiting_path, None
+            self.load_and_process_image(path)
+
+    def on_model_failed(self, error):
+        self.waiting_path = None
+        self.setWindowTitle("image colorization - model not loaded")
+        QMessageBox.critical(self, "model error", f"could not load the model:\n{error}")
 
     def load_and_process_image(self, file_name):
         #save selected image path
         self.input_image_path = file_name
-        
-        #send image to color function
-        gray, color, enhanced = colorize_image(self.input_image_path, self.model)
-
-        #this helper changes pil or numpy image into qpmap
-        def to_qpixmap(img):
-            #if it is pil image change to array
-            if hasattr(img, 'mode'):
-                img = np.array(img)
-            
-            #if it is gray image
-            if len(img.shape) == 2:
-                h, w = img.shape
-                qimg = QImage(img.data, w, h, w, QImage.Format_Grayscale8)
-            else:
-                h, w, ch = img.shape
-                if ch == 3:
-                    qimg = QImage(img.data, w, h, w * ch, QImage.Format_RGB888)
-                else:
-                    qimg = QImage(img.data, w, h, w * ch, QImage.Format_RGB888)
-            return QPixmap.fromImage(qimg)
 
+        #a newer selection replaces the one that is still running
+        if self.worker is not None:
+            self.worker.cancel()
+        self.job_id += 1
+        self.worker = None
+        self.chroma = None
+
+        if self.model is None and self.client is None:
+            self.waiting_path = file_name
+            self.setWindowTitle("image colorization - loading model")
+            return
+
+        #send image to color function in the background
+        self.worker = ColorizeWorker(self.job_id, file_name, model=self.model, client=self.client, cache=self.cache,
+                                     preview_size=self.preview_size() if self.progressive else None)
+        self.worker.signals.progress.connect(self.on_progress)
+        self.worker.signals.preview.connect(self.on_preview)
+        self.worker.signals.finished.connect(self.on_finished)
+        self.worker.signals.failed.connect(self.on_failed)
+        self.worker.signals.cancelled.connect(self.on_cancelled)
+        self.jobs[self.job_id] = self.worker
+        self.pool.start(self.worker)
+
+    #size in screen pixels the previews are made at, big enough for the largest label
+    def preview_size(self):
+        labels = (self.ui.inputimagelabel, self.ui.outputimagelabel, self.ui.enhancedimage)
+        scale = self.devicePixelRatioF()
+        w = max(label.width() for label in labels)
+        h = max(label.height() for label in labels)
+        return max(1, int(w * scale)), max(1, int(h * scale))
+
+    def on_progress(self, job_id, stage):
+        if job_id == self.job_id:
+            self.setWindowTitle(f"image colorization - {STAGE_TEXT.get(stage, stage)}")
+
+    #a preview step of the progressive mode, the refined one comes again with on_finished
+    def on_preview(self, job_id, step, images):
+        if job_id != self.job_id or step not in PREVIEW_TEXT:
+            return
+        self.setWindowTitle(f"image colorization - {PREVIEW_TEXT[step]}")
+        self.show_images(*images)
+
+    def on_cancelled(self, job_id):
+        self.jobs.pop(job_id, None)
+
+    def on_failed(self, job_id, error):
+        self.jobs.pop(job_id, None)
+        if job_id != self.job_id:
+            return
+        self.worker = None
+        self.setWindowTitle("image colorization - failed")
+        QMessageBox.warning(self, "colorization failed", error)
+
+    def on_finished(self, job_id, result):
+        #results of a replaced selection are thrown away
+        worker = self.jobs.pop(job_id, None)
+        if job_id != self.job_id:
+            return
+        self.worker = None
+        self.setWindowTitle("image colorization - done" + timing_text(worker.timings if worker else {}))
+        self.chroma = worker.chroma if worker else None
+        self.show_images(*result)
+
+    def show_images(self, gray, color, enhanced):
         #change images to qpixmap
         self.input_pixmap = to_qpixmap(gray)
         self.output_pixmap = to_qpixmap(color)
@@ -104,6 +256,9 @@ class mywindow(QWidget):
         if not self.output_pixmap:
             QMessageBox.warning(self, "no output", "no output image to save!")
             return
+        if self.progressive and self.chroma is None:
+            QMessageBox.information(self, "not ready", "the image is still being colorized")
+            return
 
         #make file name for saving
         base_name = os.path.splitext(os.path.basename(self.input_image_path))[0]
@@ -116,17 +271,44 @@ class mywindow(QWidget):
             "PNG (*.png);;JPG (*.jpg)"
         )
 
-        if file_name:
+        if not file_name:
+            return
+        if self.chroma is None:
             self.output_pixmap.save(file_name)
             QMessageBox.information(self, "saved", f"output saved to {file_name}")
+            return
+
+        #the shown image is only preview sized, the full resolution one is made in the background
+        self.save_worker = SaveWorker(self.chroma, file_name)
+        self.save_worker.signals.finished.connect(self.on_saved)
+        self.save_worker.signals.failed.connect(self.on_save_failed)
+        if self.worker is None:
+            self.setWindowTitle("image colorization - saving")
+        self.pool.start(self.save_worker)
+
+    def on_saved(self, file_name):
+        self.save_worker = None
+        #a newer image that is being worked on keeps its own title
+        if self.worker is None:
+            self.setWindowTitle("image colorization - done")
+        QMessageBox.information(self, "saved", f"output saved to {file_name}")
+
+    def on_save_failed(self, error):
+        self.save_worker = None
+        #a newer image that is being worked on keeps its own title
+        if self.worker is None:
+            self.setWindowTitle("image colorization - save failed")
+        QMessageBox.warning(self, "save failed", error)
 
 #main
 if __name__ == "__main__":
     app = QApplication(sys.argv)
+    timer = StartupTimer(START_TIME)
+    timer.mark("imports done")
     
     #show welcome window first
     welcome = WelcomeWindow()
-    main_window = mywindow()
+    main_window = mywindow(timer)
     
     #connect welcome window to main window
     def on_image_selected(image_path):
@@ -136,5 +318,7 @@ if __name__ == "__main__":
     
     welcome.image_selected.connect(on_image_selected)
     welcome.show()
+    #runs once the event loop has drawn the welcome window
+    QTimer.singleShot(0, lambda: timer.mark("first window shown"))
     
     sys.exit(app.exec())
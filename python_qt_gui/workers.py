@@ -0,0 +1,134 @@
+#background workers for the gui
+#model loading and colorization run on the QThreadPool so the window never freezes,
+#they talk back to the window with signals (signals cross threads safely in Qt)
+
+from PySide6.QtCore import QObject, QRunnable, Signal
+
+from pseudocolor import metrics
+from pseudocolor.backends import load_backend
+from pseudocolor.colorization import (ColorizationCancelled, colorize_image, colorize_progressive,
+                                     render_single_output)
+
+
+class ModelLoaderSignals(QObject):
+    loaded = Signal(object)  #the loaded model
+    failed = Signal(str)
+
+
+#loads the model backend in the background (this is where tensorflow gets imported)
+#and runs one dummy prediction so the first real image does not pay the warm up cost
+class ModelLoader(QRunnable):
+    def __init__(self, model_path, timer=None):
+        super().__init__()
+        self.model_path = model_path
+        self.timer = timer
+        self.signals = ModelLoaderSignals()
+
+    def run(self):
+        try:
+            model = load_backend(self.model_path)
+            if self.timer is not None:
+                self.timer.mark("model loaded")
+            model.warm_up()
+            if self.timer is not None:
+                self.timer.mark("model warmed up")
+        except Exception as e:
+            self.signals.failed.emit(str(e))
+            return
+        self.signals.loaded.emit(model)
+
+
+class ColorizeSignals(QObject):
+    progress = Signal(int, str)  #job id, stage name
+    preview = Signal(int, str, object)  #job id, preview step, (gray, color, enhanced) at preview size
+    finished = Signal(int, object)  #job id, (gray, color, enhanced)
+    failed = Signal(int, str)  #job id, error text
+    cancelled = Signal(int)  #job id
+
+
+#colorizes one image in the background
+#job_id lets the window ignore results of jobs that were replaced by a newer selection
+#cancel() stops the job at the next stage, a model call that already started still finishes
+#timings has the seconds of every stage of this job (see metrics.collect) once it is finished
+#with a preview_size (w, h) and a local model the job is progressive: the preview signal gets the
+#quick, full tta and refined results at preview size (see colorize_progressive), cache is then a
+#ChromaCache and chroma keeps (gray, A_avg, B_avg) so the full resolution output can be made later
+class ColorizeWorker(QRunnable):
+    def __init__(self, job_id, image_path, model=None, client=None, cache=None, preview_size=None):
+        super().__init__()
+        self.job_id = job_id
+        self.image_path = image_path
+        self.model = model
+        self.client = client
+        self.cache = cache
+        self.preview_size = preview_size
+        self.is_cancelled = False
+        self.timings = {}
+        self.chroma = None
+        self.preview = None
+        self.signals = ColorizeSignals()
+        #the window keeps a reference to call cancel(), so Qt must not delete it after run
+        self.setAutoDelete(False)
+
+    def cancel(self):
+        self.is_cancelled = True
+
+    def _progress(self, stage):
+        if self.is_cancelled:
+            raise ColorizationCancelled()
+        self.signals.progress.emit(self.job_id, stage)
+
+    def _show(self, step, images):
+        if self.is_cancelled:
+            raise ColorizationCancelled()
+        self.preview = images
+        self.signals.preview.emit(self.job_id, step, images)
+
+    def run(self):
+        try:
+            with metrics.collect(self.timings):
+                if self.client is not None:
+                    self._progress("inference")
+                    with metrics.timer("server"):
+                        result = self.client.colorize_image(self.image_path)
+                elif self.preview_size is not None:
+                    self.chroma = colorize_progressive(self.image_path, self.model, self.preview_size, self._show,
+                                                       chroma_cache=self.cache, progress=self._progress)
+                    result = self.preview
+                else:
+                    result = colorize_image(self.image_path, self.model, cache=self.cache, progress=self._progress)
+            if self.is_cancelled:
+                raise ColorizationCancelled()
+        except ColorizationCancelled:
+            self.signals.cancelled.emit(self.job_id)
+            return
+        except Exception as e:
+            self.signals.failed.emit(self.job_id, str(e))
+            return
+        self.signals.finished.emit(self.job_id, result)
+
+
+class SaveSignals(QObject):
+    finished = Signal(str)  #file name
+    failed = Signal(str)  #error text
+
+
+#renders the full resolution output of the progressive mode from its chroma and saves it,
+#in the background because the full size render of a big scan takes a moment
+class SaveWorker(QRunnable):
+    def __init__(self, chroma, file_name, output="color"):
+        super().__init__()
+        self.chroma = chroma
+        self.file_name = file_name
+        self.output = output
+        self.signals = SaveSignals()
+        #the window keeps a reference until the signal is handled
+        self.setAutoDelete(False)
+
+    def run(self):
+        try:
+            render_single_output(*self.chroma, output=self.output).save(self.file_name)
+        except Exception as e:
+            self.signals.failed.emit(str(e))
+            return
+        self.signals.finished.emit(self.file_name)
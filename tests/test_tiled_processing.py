@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from pseudocolor.tiled_processing import filter_radius, tiled_render
+
+
+def _inputs():
+    rng = np.random.default_rng(0)
+    gray = rng.integers(0, 256, (600, 300), dtype=np.uint8)
+    A_avg = (128 + 40 * rng.standard_normal((128, 128))).astype(np.float32)
+    B_avg = (128 + 40 * rng.standard_normal((128, 128))).astype(np.float32)
+    return gray, A_avg, B_avg
+
+
+def test_filter_radius():
+    assert filter_radius(None) == 0
+    assert filter_radius((9, 75, 75)) == 4
+    assert filter_radius((0, 75, 10)) == 15
+    assert filter_radius((-1, 75, 4)) == 6
+
+
+#the strips must join without seams: a small budget gives the same image as one strip over the
+#whole image, also when d <= 0 and opencv takes the filter radius from sigma_space
+@pytest.mark.parametrize("bilateral", [(9, 75, 75), (0, 75, 10), (-1, 50, 6), None])
+def test_strips_match_whole_image(bilateral):
+    gray, A_avg, B_avg = _inputs()
+    whole = tiled_render(gray, A_avg, B_avg, bilateral=bilateral, budget_mb=1000)
+    strips = tiled_render(gray, A_avg, B_avg, bilateral=bilateral, budget_mb=0.5)
+    np.testing.assert_array_equal(strips, whole)